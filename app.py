@@ -3,17 +3,22 @@
 # Streamlit + SQLite Persistente
 # ==========================================
 import os
+import atexit
+import pathlib
 import re
+import sys
 import io
-import shutil
+import hashlib
 import sqlite3
 import datetime
+import functools
+import threading
+import time
 from datetime import datetime as dt
-from typing import Optional, Tuple, List, Dict
+from typing import Optional, Tuple, List, Dict, Iterable, Iterator
+import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 
 # ==========================================
 # Config & Database - SQLITE PERSISTENTE
@@ -34,20 +39,146 @@ BACKUP_DIR = os.path.join(DATA_DIR, "backups")
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
+def _sql_casefold(s):
+    """casefold() registrada no SQLite (valores não-texto passam direto)"""
+    return s.casefold() if isinstance(s, str) else s
+
+@st.cache_resource(show_spinner=False)
 def get_conn():
+    """Conexão única por processo (SQLite funciona melhor com um só handle)"""
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -64000;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    # casefold(): comparação sem maiúsculas que também vale para acentos (o LIKE só trata ASCII)
+    conn.create_function("casefold", 1, _sql_casefold, deterministic=True)
+    atexit.register(_close_on_exit, conn)
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_read_conn() -> sqlite3.Connection:
+    """Conexão só de leitura das consultas: vê apenas dados confirmados, nunca a transação aberta de uma escrita"""
+    get_conn()  # garante o arquivo e o modo WAL antes de abrir em mode=ro
+    conn = sqlite3.connect(pathlib.Path(DB_PATH).as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -64000;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    conn.create_function("casefold", 1, _sql_casefold, deterministic=True)
+    atexit.register(conn.close)
     return conn
 
-def backup_database():
-    """Faz backup do banco de dados"""
+def _close_on_exit(conn: sqlite3.Connection) -> None:
+    """Atualiza as estatísticas que mudaram e fecha a conexão ao encerrar o processo"""
+    try:
+        conn.execute("PRAGMA optimize;")
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+@st.cache_resource(show_spinner=False)
+def _write_lock() -> threading.RLock:
+    return threading.RLock()
+
+def _locked_write(func):
+    """Serializa as escritas na conexão compartilhada e descarta transações deixadas abertas"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _write_lock():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                con = get_conn()
+                if con.in_transaction:
+                    con.rollback()
+    return wrapper
+
+BACKUP_MIN_INTERVAL = 60  # segundos entre backups automáticos antes de edições
+BACKUP_STEP_PAGES = 1024  # páginas copiadas por passo da API de backup do SQLite
+
+def _new_backup_path() -> str:
     timestamp = dt.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = os.path.join(BACKUP_DIR, f"estoque_backup_{timestamp}.db")
-    if os.path.exists(DB_PATH):
-        shutil.copy2(DB_PATH, backup_path)
-    else:
-        open(backup_path, "wb").close()
-    return backup_path
+    return os.path.join(BACKUP_DIR, f"estoque_backup_{timestamp}.db")
+
+def _snapshot_conn() -> sqlite3.Connection:
+    """Conexão própria com leitura aberta: congela o estado atual do banco (WAL)"""
+    src = sqlite3.connect(DB_PATH, check_same_thread=False)
+    src.execute("BEGIN")
+    src.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+    return src
+
+BACKUP_ERROR_LOG = os.path.join(BACKUP_DIR, "backup_errors.log")
+
+def _copy_snapshot(src: sqlite3.Connection, backup_path: str) -> None:
+    """Copia o snapshot (roda em thread); falhas vão para BACKUP_ERROR_LOG, não para a tela"""
+    try:
+        dst = sqlite3.connect(backup_path)
+        try:
+            src.backup(dst, pages=BACKUP_STEP_PAGES)
+        finally:
+            dst.close()
+    except (sqlite3.Error, OSError) as e:
+        with open(BACKUP_ERROR_LOG, "a", encoding="utf-8") as log:
+            log.write(f"{_now_ts()} {os.path.basename(backup_path)}: {e}\n")
+    finally:
+        src.close()
+
+def backup_database() -> Tuple[str, str]:
+    """Faz backup do banco de dados (pela conexão compartilhada, sem escritas no meio); retorna (caminho, nome)"""
+    backup_path = _new_backup_path()
+    dst = sqlite3.connect(backup_path)
+    try:
+        with _write_lock():
+            get_conn().backup(dst, pages=BACKUP_STEP_PAGES)
+    finally:
+        dst.close()
+    return backup_path, os.path.basename(backup_path)
+
+MANUAL_BACKUP_WINDOW = 300  # cliques repetidos nesta janela reaproveitam o mesmo backup
+
+@st.cache_data(ttl=MANUAL_BACKUP_WINDOW, max_entries=20, show_spinner="Fazendo backup…")
+def _manual_backup(bucket: int) -> Tuple[str, str]:
+    """Backup do botão da sidebar: um por janela de tempo (bucket)"""
+    return backup_database()
+
+@st.cache_resource(show_spinner=False)
+def _auto_backup_state() -> dict:
+    return {"last": 0.0, "lock": threading.Lock()}
+
+def backup_database_async(force: bool = False) -> None:
+    """Backup antes de edições: copia em segundo plano, no máximo um por BACKUP_MIN_INTERVAL (salvo force)"""
+    state = _auto_backup_state()
+    with state["lock"]:
+        now = time.time()
+        if not force and now - state["last"] < BACKUP_MIN_INTERVAL:
+            return
+        state["last"] = now
+    # O snapshot é aberto aqui, antes da edição; só a cópia vai para a thread
+    src = _snapshot_conn()
+    threading.Thread(target=_copy_snapshot, args=(src, _new_backup_path()), daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def _write_counter() -> dict:
+    """Contador de escritas do processo (compartilhado por todas as sessões)"""
+    return {"n": 0, "lock": threading.Lock()}
+
+def _db_version() -> Tuple[float, int]:
+    """Chave de cache das consultas: mtime do banco + contador de escritas do processo"""
+    mtime = 0.0
+    for path in (DB_PATH, DB_PATH + "-wal"):
+        try:
+            mtime = max(mtime, os.path.getmtime(path))
+        except OSError:
+            pass
+    return mtime, _write_counter()["n"]
+
+def _bump_db_version() -> None:
+    """Invalida as consultas em cache após uma escrita (para todas as sessões)"""
+    counter = _write_counter()
+    with counter["lock"]:
+        counter["n"] += 1
 
 @st.cache_resource(show_spinner=False)
 def init_db() -> None:
@@ -81,52 +212,81 @@ def init_db() -> None:
             sku_pdf TEXT NOT NULL UNIQUE,
             sku_estoque TEXT NOT NULL REFERENCES variants(sku) ON DELETE CASCADE
         );
-        CREATE VIEW IF NOT EXISTS stock_view AS
-        SELECT v.id AS variant_id, v.sku, COALESCE(SUM(m.qty),0) AS stock
+        CREATE INDEX IF NOT EXISTS idx_movements_variant ON movements(variant_id);
+        CREATE INDEX IF NOT EXISTS idx_movements_ts ON movements(ts);
+        CREATE INDEX IF NOT EXISTS idx_sku_mapping_estoque ON sku_mapping(sku_estoque);
+        -- Saldo materializado por variante, mantido pelos triggers de movements
+        CREATE TABLE IF NOT EXISTS stock_cache (
+            variant_id INTEGER PRIMARY KEY REFERENCES variants(id) ON DELETE CASCADE,
+            stock INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_movements_stock_ins AFTER INSERT ON movements BEGIN
+            INSERT INTO stock_cache(variant_id, stock, updated_at) VALUES (NEW.variant_id, NEW.qty, NEW.ts)
+            ON CONFLICT(variant_id) DO UPDATE SET stock = stock + excluded.stock, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_movements_stock_upd AFTER UPDATE OF variant_id, qty ON movements BEGIN
+            UPDATE stock_cache SET stock = stock - OLD.qty WHERE variant_id = OLD.variant_id;
+            INSERT INTO stock_cache(variant_id, stock, updated_at) VALUES (NEW.variant_id, NEW.qty, NEW.ts)
+            ON CONFLICT(variant_id) DO UPDATE SET stock = stock + excluded.stock, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_movements_stock_del AFTER DELETE ON movements BEGIN
+            UPDATE stock_cache SET stock = stock - OLD.qty WHERE variant_id = OLD.variant_id;
+        END;
+        -- Carga inicial (banco criado antes do stock_cache)
+        INSERT INTO stock_cache(variant_id, stock, updated_at)
+        SELECT variant_id, SUM(qty), MAX(ts) FROM movements
+        WHERE NOT EXISTS (SELECT 1 FROM stock_cache)
+        GROUP BY variant_id;
+        DROP VIEW IF EXISTS stock_view;
+        CREATE VIEW stock_view AS
+        SELECT v.id AS variant_id, v.sku, COALESCE(c.stock,0) AS stock
         FROM variants v
-        LEFT JOIN movements m ON m.variant_id = v.id
-        GROUP BY v.id, v.sku;
-        CREATE VIEW IF NOT EXISTS stock_value_view AS
+        LEFT JOIN stock_cache c ON c.variant_id = v.id;
+        DROP VIEW IF EXISTS stock_value_view;
+        CREATE VIEW stock_value_view AS
         SELECT v.sku, p.category, p.subtype, v.color, v.size,
-               COALESCE(SUM(m.qty),0) AS estoque,
+               COALESCE(c.stock,0) AS estoque,
                COALESCE(v.custo_unitario, p.custo_unitario, 0) AS custo_unitario,
-               (COALESCE(SUM(m.qty),0) * COALESCE(v.custo_unitario, p.custo_unitario, 0)) AS valor_estoque
+               (COALESCE(c.stock,0) * COALESCE(v.custo_unitario, p.custo_unitario, 0)) AS valor_estoque
         FROM variants v
         JOIN products p ON p.id = v.product_id
-        LEFT JOIN movements m ON m.variant_id = v.id
-        GROUP BY v.id, v.sku;
+        LEFT JOIN stock_cache c ON c.variant_id = v.id;
+
+        -- Estatísticas para o planejador escolher a ordem dos JOINs
+        ANALYZE;
     """)
     con.commit()
 
+def _cols(cur: sqlite3.Cursor, tbl: str) -> set:
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({tbl})")}
+
+@_locked_write
 def migrate_db() -> None:
     """Migra o banco de dados para a versão mais recente"""
     con = get_conn()
     cur = con.cursor()
+    product_cols = _cols(cur, "products")
+    variant_cols = _cols(cur, "variants")
     
     # sku_base em products
-    try:
-        cur.execute("SELECT sku_base FROM products LIMIT 1")
-    except sqlite3.OperationalError:
+    if "sku_base" not in product_cols:
         cur.execute("ALTER TABLE products ADD COLUMN sku_base TEXT")
         st.info("✓ Coluna sku_base adicionada à tabela products")
     
     # custo_unitario em products
-    try:
-        cur.execute("SELECT custo_unitario FROM products LIMIT 1")
-    except sqlite3.OperationalError:
+    if "custo_unitario" not in product_cols:
         cur.execute("ALTER TABLE products ADD COLUMN custo_unitario REAL DEFAULT 0")
         st.info("✓ Coluna custo_unitario adicionada à tabela products")
     
     # custo_unitario em variants
-    try:
-        cur.execute("SELECT custo_unitario FROM variants LIMIT 1")
-    except sqlite3.OperationalError:
+    if "custo_unitario" not in variant_cols:
         cur.execute("ALTER TABLE variants ADD COLUMN custo_unitario REAL")
         st.info("✓ Coluna custo_unitario adicionada à tabela variants")
     
     # tabela sku_mapping
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sku_mapping'")
-    if not cur.fetchone():
+    tables = {r[0] for r in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "sku_mapping" not in tables:
         cur.execute("""
             CREATE TABLE sku_mapping (
                 id INTEGER PRIMARY KEY,
@@ -136,32 +296,49 @@ def migrate_db() -> None:
         """)
         st.info("✓ Tabela sku_mapping criada")
     
+    # UNIQUE(category, subtype) em products (usado pelo UPSERT de get_or_create_product)
+    try:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_products_cat_sub ON products(category, subtype)")
+        cur.execute("DROP INDEX IF EXISTS idx_products_cat_sub")
+    except sqlite3.IntegrityError:
+        # Banco com categoria/subtipo duplicados: mantém índice simples para as buscas
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_products_cat_sub ON products(category, subtype)")
+    
     con.commit()
 
 # ==========================================
 # Helpers: SKU
 # ==========================================
+_COLOR_CLEAN_RE = re.compile(r'[^a-zA-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇáàâãéèêíìîóòôõúùûç ]')
+_NON_ALNUM_RE = re.compile(r'[^A-Za-z0-9]')
+_SKU_INVALID_RE = re.compile(r"[^A-Z0-9\-_ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]")
+_KEY_INVALID_RE = re.compile(r'[^A-Z0-9]')
+
 def generate_sku(sku_base: str, color: str, size: str) -> str:
-    cor_limpa = re.sub(r'[^a-zA-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇáàâãéèêíìîóòôõúùûç ]', '', color.strip()).strip().title().replace(" ", "")
-    tamanho_limpo = re.sub(r'[^A-Za-z0-9]', '', size.strip().upper())
+    cor_limpa = _COLOR_CLEAN_RE.sub('', color.strip()).strip().title().replace(" ", "")
+    tamanho_limpo = _NON_ALNUM_RE.sub('', size.strip().upper())
     sku_base_limpo = sku_base.strip().upper().replace(" ", "")
     return f"{sku_base_limpo}-{cor_limpa}-{tamanho_limpo}"
 
 def sanitize_sku(s: str) -> str:
     s = (s or "").strip().upper().replace(" ", "")
-    return re.sub(r"[^A-Z0-9\-_ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]", "", s)
+    return _SKU_INVALID_RE.sub("", s)
+
+def _sanitize_sku_series(col: pd.Series) -> pd.Series:
+    """sanitize_sku aplicado à coluna inteira (vazios/NA viram "")"""
+    txt = col.fillna("").astype(str)
+    return txt.str.strip().str.upper().str.replace(" ", "", regex=False).str.replace(_SKU_INVALID_RE, "", regex=True)
 
 def normalize_key(s: str) -> str:
-    return re.sub(r'[^A-Z0-9]', '', sanitize_sku(s))
+    return _KEY_INVALID_RE.sub('', sanitize_sku(s))
 
 def sanitized_to_original_sku_map() -> Dict[str, str]:
-    vdf = list_variants_df()
-    orig_list = vdf["sku"].astype(str).tolist()
-    return {sanitize_sku(s): s for s in orig_list}
+    return {sanitize_sku(s): s for s in list_variant_skus()}
 
 # ==========================================
 # CRUD Operations
 # ==========================================
+@_locked_write
 def get_or_create_product(category: str, subtype: str, sku_base: Optional[str] = None, custo_unitario: Optional[float] = None) -> int:
     """
     Regra:
@@ -171,6 +348,35 @@ def get_or_create_product(category: str, subtype: str, sku_base: Optional[str] =
         - Atualiza custo_unitario SÓ se custo_unitario for passado (não None).
         - Se custo_unitario for None, NÃO mexe no custo já cadastrado.
     """
+    con = get_conn()
+    custo = float(custo_unitario) if custo_unitario is not None else None
+    try:
+        row = con.execute(
+            """
+            INSERT INTO products(category, subtype, sku_base, custo_unitario) VALUES(?, ?, ?, COALESCE(?, 0))
+            ON CONFLICT(category, subtype) DO UPDATE SET
+                sku_base = CASE WHEN ? THEN excluded.sku_base ELSE products.sku_base END,
+                custo_unitario = COALESCE(?, products.custo_unitario)
+            WHERE (? AND products.sku_base IS NOT excluded.sku_base)
+               OR products.custo_unitario IS NOT COALESCE(?, products.custo_unitario)
+            RETURNING id
+            """,
+            (category.strip(), subtype.strip(), sku_base.strip() if sku_base else None, custo,
+             sku_base is not None, custo, sku_base is not None, custo)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # Sem o índice único (produtos duplicados) ou SQLite < 3.35
+        return _get_or_create_product_fallback(category, subtype, sku_base, custo_unitario)
+    con.commit()
+    if row is None:
+        # Já existia com os mesmos valores: nada mudou, os caches continuam válidos
+        return con.execute(
+            "SELECT id FROM products WHERE category=? AND subtype=?", (category.strip(), subtype.strip())
+        ).fetchone()[0]
+    _bump_db_version()
+    return row[0]
+
+def _get_or_create_product_fallback(category: str, subtype: str, sku_base: Optional[str], custo_unitario: Optional[float]) -> int:
     con = get_conn()
     cur = con.cursor()
     cur.execute(
@@ -201,6 +407,7 @@ def get_or_create_product(category: str, subtype: str, sku_base: Optional[str] =
                 params
             )
             con.commit()
+            _bump_db_version()
 
         return row[0]
 
@@ -223,9 +430,22 @@ def get_or_create_product(category: str, subtype: str, sku_base: Optional[str] =
         )
 
     con.commit()
+    _bump_db_version()
     return cur.lastrowid
 
+@st.cache_resource(show_spinner=False)
+def _sku_resolver():
+    """LRU de SKU -> variant_id que sobrevive aos reruns; limpo nas escritas em variants"""
+    @functools.lru_cache(maxsize=2048)
+    def resolve(sku: str) -> Optional[int]:
+        row = get_read_conn().execute("SELECT id FROM variants WHERE sku=?", (sku,)).fetchone()
+        return row[0] if row else None
+    return resolve
 
+def resolve_sku(sku: str) -> Optional[int]:
+    return _sku_resolver()(sku)
+
+@_locked_write
 def create_variant(category: str, subtype: str, color: str, size: str, sku_base: Optional[str] = None, sku_override: Optional[str] = None, custo_unitario_produto: float = 0, custo_unitario_variante: Optional[float] = None) -> Tuple[bool, str]:
     con = get_conn()
     cur = con.cursor()
@@ -251,25 +471,111 @@ def create_variant(category: str, subtype: str, color: str, size: str, sku_base:
         cur.execute("INSERT INTO variants(product_id, color, size, sku, custo_unitario) VALUES(?,?,?,?,?)",
                    (product_id, color.strip(), size.strip(), sku, float(custo_unitario_variante) if custo_unitario_variante else None))
         con.commit()
+        _bump_db_version()
+        _sku_resolver().cache_clear()
         return True, sku
     except sqlite3.IntegrityError as e:
         return False, f"Não foi possível criar a variante. SKU já existe? Detalhe: {e}"
 
-def record_movement(sku: str, qty: int, reason: str) -> None:
+def _now_ts() -> str:
+    """Timestamp das movimentações (um por lote)"""
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+@_locked_write
+def record_movement(sku: str, qty: int, reason: str, ts: Optional[str] = None) -> None:
     con = get_conn()
     cur = con.cursor()
-    cur.execute("SELECT id FROM variants WHERE sku=?", (sku,))
-    row = cur.fetchone()
-    if not row:
+    variant_id = resolve_sku(sku)
+    if variant_id is None:
         raise ValueError("SKU não encontrado.")
-    variant_id = row[0]
     cur.execute("INSERT INTO movements(variant_id, qty, reason, ts) VALUES(?,?,?,?)",
-               (variant_id, qty, reason, datetime.datetime.now().isoformat(timespec="seconds")))
+               (variant_id, qty, reason, ts or _now_ts()))
     con.commit()
+    _bump_db_version()
 
+def _insert_movements(cur: sqlite3.Cursor, items: List[Tuple[str, int, str]], ts: str) -> int:
+    """Insere (sku, qty, reason) resolvendo SKU -> variant_id no banco; exige transação aberta"""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_movements (sku TEXT NOT NULL, qty INTEGER NOT NULL, reason TEXT NOT NULL)")
+    cur.execute("DELETE FROM tmp_movements")
+    cur.executemany("INSERT INTO tmp_movements(sku, qty, reason) VALUES(?,?,?)", items)
+    faltando = [r[0] for r in cur.execute(
+        "SELECT DISTINCT t.sku FROM tmp_movements t LEFT JOIN variants v ON v.sku = t.sku WHERE v.id IS NULL"
+    )]
+    if faltando:
+        raise ValueError(f"SKU não encontrado: {', '.join(faltando)}")
+    # Resolve SKU -> variant_id e insere tudo em um único comando
+    cur.execute(
+        "INSERT INTO movements(variant_id, qty, reason, ts) "
+        "SELECT v.id, t.qty, t.reason, ? FROM tmp_movements t JOIN variants v ON v.sku = t.sku ORDER BY t.rowid",
+        (ts,)
+    )
+    inseridos = cur.rowcount
+    cur.execute("DELETE FROM tmp_movements")
+    return inseridos
+
+def _upsert_mappings(cur: sqlite3.Cursor, pairs: List[Tuple[str, str]]) -> None:
+    cur.executemany(
+        "INSERT INTO sku_mapping(sku_pdf, sku_estoque) VALUES(?, ?) "
+        "ON CONFLICT(sku_pdf) DO UPDATE SET sku_estoque=excluded.sku_estoque",
+        pairs
+    )
+
+@_locked_write
+def record_movements_bulk(items: List[Tuple[str, int, str]], ts: Optional[str] = None) -> int:
+    """Registra várias movimentações (sku, qty, reason) em uma única transação"""
+    if not items:
+        return 0
+    con = get_conn()
+    with con:
+        inseridos = _insert_movements(con.cursor(), items, ts or _now_ts())
+    _bump_db_version()
+    return inseridos
+
+@_locked_write
+def upsert_sku_mappings(pairs: List[Tuple[str, str]]) -> int:
+    """Grava vários mapeamentos (sku_pdf, sku_estoque) em uma única transação"""
+    if not pairs:
+        return 0
+    con = get_conn()
+    with con:
+        _upsert_mappings(con.cursor(), pairs)
+    _bump_db_version()
+    return len(pairs)
+
+@_locked_write
+def delete_sku_mapping(id: Optional[int] = None, sku_pdf: Optional[str] = None) -> int:
+    """Exclui um mapeamento pelo id ou pelo sku_pdf; retorna quantos foram removidos"""
+    if id is None and not sku_pdf:
+        return 0
+    con = get_conn()
+    with con:
+        if id is not None:
+            removidos = con.execute("DELETE FROM sku_mapping WHERE id=?", (int(id),)).rowcount
+        else:
+            removidos = con.execute("DELETE FROM sku_mapping WHERE sku_pdf=?", (str(sku_pdf),)).rowcount
+    _bump_db_version()
+    return removidos
+
+@_locked_write
+def apply_pdf_baixas(baixas: List[Tuple[str, int, str]], mapeamentos: List[Tuple[str, str]]) -> Tuple[int, int]:
+    """Baixas e mapeamentos do PDF em uma só transação (um commit/fsync por PDF)"""
+    if not baixas and not mapeamentos:
+        return 0, 0
+    con = get_conn()
+    cur = con.cursor()
+    inseridos = 0
+    with con:
+        if baixas:
+            inseridos = _insert_movements(cur, baixas, _now_ts())
+        if mapeamentos:
+            _upsert_mappings(cur, mapeamentos)
+    _bump_db_version()
+    return inseridos, len(mapeamentos)
+
+@_locked_write
 def update_variant(old_sku: str, new_sku: str, category: str, subtype: str, color: str, size: str, sku_base: Optional[str] = None, custo_unitario_produto: Optional[float] = None, custo_unitario_variante: Optional[float] = None) -> Tuple[bool, str]:
     try:
-        backup_database()
+        backup_database_async()
         con = get_conn()
         cur = con.cursor()
         cur.execute("SELECT id, product_id FROM variants WHERE sku=?", (old_sku,))
@@ -291,13 +597,16 @@ def update_variant(old_sku: str, new_sku: str, category: str, subtype: str, colo
         if cur.fetchone()[0] == 0:
             cur.execute("DELETE FROM products WHERE id=?", (old_product_id,))
         con.commit()
+        _bump_db_version()
+        _sku_resolver().cache_clear()
         return True, "Variante atualizada com sucesso!"
     except sqlite3.Error as e:
         return False, f"Erro ao atualizar variante: {e}"
 
+@_locked_write
 def update_sku_base_bulk(category: str, subtype: str, new_sku_base: str) -> Tuple[bool, str]:
     try:
-        backup_database()
+        backup_database_async()
         con = get_conn()
         cur = con.cursor()
         cur.execute("SELECT id FROM products WHERE category=? AND subtype=?", (category, subtype))
@@ -315,13 +624,16 @@ def update_sku_base_bulk(category: str, subtype: str, new_sku_base: str) -> Tupl
         except sqlite3.OperationalError:
             return False, "A coluna sku_base não existe. Execute a migração do banco de dados primeiro."
         con.commit()
+        _bump_db_version()
+        _sku_resolver().cache_clear()
         return True, f"SKU base atualizado e {len(variants)} variantes regeneradas com sucesso!"
     except sqlite3.Error as e:
         return False, f"Erro ao atualizar SKU base: {e}"
 
+@_locked_write
 def update_custo_unitario(category: str, subtype: str, novo_custo: float) -> Tuple[bool, str]:
     try:
-        backup_database()
+        backup_database_async()
         con = get_conn()
         cur = con.cursor()
         cur.execute("SELECT id FROM products WHERE category=? AND subtype=?", (category, subtype))
@@ -331,13 +643,30 @@ def update_custo_unitario(category: str, subtype: str, novo_custo: float) -> Tup
         product_id = product[0]
         cur.execute("UPDATE products SET custo_unitario=? WHERE id=?", (novo_custo, product_id))
         con.commit()
+        _bump_db_version()
         return True, f"Custo unitário (PRODUTO) atualizado para R$ {novo_custo:.2f}"
     except sqlite3.Error as e:
         return False, f"Erro ao atualizar custo unitário: {e}"
 
+@_locked_write
+def bulk_update_custo(category: str, subtypes: List[str], novo_custo: float) -> int:
+    """Custo padrão de vários subtipos da categoria em um único UPDATE (sem subtipos = todos); retorna produtos alterados"""
+    backup_database_async()
+    con = get_conn()
+    sql = "UPDATE products SET custo_unitario=? WHERE category=?"
+    params: List = [novo_custo, category]
+    if subtypes:
+        sql += f" AND subtype IN ({','.join('?' * len(subtypes))})"
+        params.extend(subtypes)
+    with con:
+        updated = con.execute(sql, params).rowcount
+    _bump_db_version()
+    return updated
+
+@_locked_write
 def delete_variant(sku: str) -> Tuple[bool, str]:
     try:
-        backup_database()
+        backup_database_async()
         con = get_conn()
         cur = con.cursor()
         cur.execute("SELECT id, product_id FROM variants WHERE sku=?", (sku,))
@@ -354,12 +683,15 @@ def delete_variant(sku: str) -> Tuple[bool, str]:
         if cur.fetchone()[0] == 0:
             cur.execute("DELETE FROM products WHERE id=?", (product_id,))
         con.commit()
+        _bump_db_version()
+        _sku_resolver().cache_clear()
         return True, "Variante removida com sucesso!"
     except sqlite3.Error as e:
         return False, f"Erro ao remover variante: {e}"
 
-def get_variant_details(sku: str) -> Optional[dict]:
-    con = get_conn()
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_variant_details(version: Tuple[float, int], sku: str) -> Optional[dict]:
+    con = get_read_conn()
     cur = con.cursor()
     try:
         cur.execute("""
@@ -378,11 +710,19 @@ def get_variant_details(sku: str) -> Optional[dict]:
         }
     return None
 
+def get_variant_details(sku: str) -> Optional[dict]:
+    return _cached_variant_details(_db_version(), sku)
+
 # ==========================================
 # Query Functions
 # ==========================================
-def list_products_df() -> pd.DataFrame:
-    con = get_conn()
+# Todas as consultas ficam em cache com a versão do banco na chave; cada escrita
+# gera chaves novas, então o limite de entradas descarta as versões antigas.
+LOADER_CACHE_MAX = 32
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_list_products(version: Tuple[float, int]) -> pd.DataFrame:
+    con = get_read_conn()
     try:
         df = pd.read_sql_query("SELECT id, category, subtype, sku_base, custo_unitario FROM products ORDER BY category, subtype", con)
     except sqlite3.OperationalError:
@@ -391,8 +731,12 @@ def list_products_df() -> pd.DataFrame:
         df['custo_unitario'] = 0
     return df
 
-def list_variants_df() -> pd.DataFrame:
-    con = get_conn()
+def list_products_df() -> pd.DataFrame:
+    return _cached_list_products(_db_version())
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_list_variants(version: Tuple[float, int]) -> pd.DataFrame:
+    con = get_read_conn()
     try:
         q = """
             SELECT v.id, v.sku, p.category, p.subtype, v.color, v.size, p.sku_base, 
@@ -413,53 +757,122 @@ def list_variants_df() -> pd.DataFrame:
         df['custo_unitario_variante'] = None
     return df
 
-def stock_df(filter_text: Optional[str] = None, critical_only: bool = False, critical_value: int = 0) -> pd.DataFrame:
-    con = get_conn()
+def list_variants_df() -> pd.DataFrame:
+    return _cached_list_variants(_db_version())
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_variant_skus(version: Tuple[float, int]) -> List[str]:
+    return [r[0] for r in get_read_conn().execute("SELECT sku FROM variants ORDER BY sku")]
+
+def list_variant_skus() -> List[str]:
+    """Só os SKUs, em ordem, para selectboxes e buscas (as telas com tabela usam list_variants_df)"""
+    return _cached_variant_skus(_db_version())
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_query(version: Tuple[float, int], sql: str, params: tuple) -> pd.DataFrame:
+    return pd.read_sql_query(sql, get_read_conn(), params=params)
+
+def cached_query(sql: str, params: tuple = ()) -> pd.DataFrame:
+    """SELECT avulso das páginas, em cache até a próxima escrita"""
+    return _cached_query(_db_version(), sql, tuple(params))
+
+# Tipos fixos para as colunas numéricas (evita inferência; valores em float64 para não perder centavos)
+_STOCK_DTYPES = {"estoque": "int32", "custo_unitario": "float64", "valor_estoque": "float64"}
+# Colunas de agrupamento das telas de valor/vendas como category: o groupby compara códigos, não strings
+_GROUP_DTYPES = dict.fromkeys(("category", "subtype", "color", "size"), "category")
+_STOCK_VALUE_DTYPES = {**_STOCK_DTYPES, **_GROUP_DTYPES}
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_stock(version: Tuple[float, int], filter_text: Optional[str], critical_only: bool, critical_value: int) -> pd.DataFrame:
+    con = get_read_conn()
     base_sql = """
         SELECT v.sku, p.category AS categoria, p.subtype AS subtipo, v.color AS cor, v.size AS tamanho,
                COALESCE(s.stock,0) AS estoque, COALESCE(v.custo_unitario, p.custo_unitario, 0) AS custo_unitario,
                (COALESCE(s.stock,0) * COALESCE(v.custo_unitario, p.custo_unitario, 0)) AS valor_estoque
-        FROM variants v JOIN products p ON p.id=v.product_id LEFT JOIN stock_view s ON s.variant_id=v.id
+        FROM variants v JOIN products p ON p.id=v.product_id LEFT JOIN stock_cache s ON s.variant_id=v.id
     """
     conditions = []
-    params = []
+    params: Tuple = ()
     if filter_text:
         conditions.append("v.sku LIKE ? OR p.category LIKE ? OR p.subtype LIKE ? OR v.color LIKE ? OR v.size LIKE ?")
         like = f"%{filter_text}%"
-        params = [like, like, like, like, like]
+        params = (like,) * 5
     if critical_only and critical_value > 0:
         conditions.append("COALESCE(s.stock,0) <= ?")
-        params.append(critical_value)
+        params += (critical_value,)
     if conditions:
         base_sql += " WHERE " + " AND ".join(conditions)
     base_sql += " ORDER BY p.category, p.subtype, v.color, v.size"
-    return pd.read_sql_query(base_sql, get_conn(), params=params)
+    return pd.read_sql_query(base_sql, con, params=params, dtype=_STOCK_DTYPES)
 
-def stock_value_df(filter_text: Optional[str] = None) -> pd.DataFrame:
-    con = get_conn()
+def stock_df(filter_text: Optional[str] = None, critical_only: bool = False, critical_value: int = 0) -> pd.DataFrame:
+    return _cached_stock(_db_version(), filter_text, critical_only, critical_value)
+
+def stock_for_sku(sku: str) -> int:
+    """Saldo de um único SKU (busca indexada em stock_cache; 0 se não houver movimentos)"""
+    row = get_read_conn().execute(
+        "SELECT COALESCE(s.stock, 0) FROM variants v LEFT JOIN stock_cache s ON s.variant_id = v.id WHERE v.sku = ?",
+        (sku,)
+    ).fetchone()
+    return int(row[0]) if row else 0
+
+def count_variants_for_products(prod_ids: List[int]) -> int:
+    """Quantidade de variantes dos produtos informados (COUNT no banco, sem carregar a tabela)"""
+    ids = [int(i) for i in prod_ids]
+    if not ids:
+        return 0
+    ph = ",".join("?" * len(ids))
+    row = get_read_conn().execute(f"SELECT COUNT(*) FROM variants WHERE product_id IN ({ph})", ids).fetchone()
+    return int(row[0]) if row else 0
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_stock_value(version: Tuple[float, int], filter_text: Optional[str], categoria: str, subtipo: str) -> pd.DataFrame:
+    con = get_read_conn()
     base_sql = "SELECT sku, category, subtype, color, size, estoque, custo_unitario, valor_estoque FROM stock_value_view"
-    params = []
+    conds, params = _category_conds(categoria, subtipo)
     if filter_text:
-        base_sql += " WHERE category LIKE ? OR subtype LIKE ? OR color LIKE ? OR size LIKE ?"
+        conds.append("(category LIKE ? OR subtype LIKE ? OR color LIKE ? OR size LIKE ?)")
         like = f"%{filter_text}%"
-        params = [like, like, like, like]
+        params += [like, like, like, like]
+    if conds:
+        base_sql += " WHERE " + " AND ".join(conds)
     base_sql += " ORDER BY category, subtype, color, size"
-    return pd.read_sql_query(base_sql, con, params=params)
+    return pd.read_sql_query(base_sql, con, params=params, dtype=_STOCK_VALUE_DTYPES)
 
-def stock_value_positive_df(filter_text: Optional[str] = None) -> pd.DataFrame:
-    """Retorna apenas itens com estoque positivo para cálculo de valor total"""
-    con = get_conn()
+def stock_value_df(filter_text: Optional[str] = None, categoria: str = "", subtipo: str = "") -> pd.DataFrame:
+    return _cached_stock_value(_db_version(), filter_text, categoria, subtipo)
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def _cached_stock_value_positive(version: Tuple[float, int], filter_text: Optional[str], categoria: str, subtipo: str) -> pd.DataFrame:
+    con = get_read_conn()
     base_sql = "SELECT sku, category, subtype, color, size, estoque, custo_unitario, valor_estoque FROM stock_value_view WHERE estoque > 0"
-    params = []
+    conds, params = _category_conds(categoria, subtipo)
+    for cond in conds:
+        base_sql += " AND " + cond
     if filter_text:
         base_sql += " AND (category LIKE ? OR subtype LIKE ? OR color LIKE ? OR size LIKE ?)"
         like = f"%{filter_text}%"
-        params = [like, like, like, like]
+        params += [like, like, like, like]
     base_sql += " ORDER BY category, subtype, color, size"
-    return pd.read_sql_query(base_sql, con, params=params)
+    return pd.read_sql_query(base_sql, con, params=params, dtype=_STOCK_VALUE_DTYPES)
 
-def movements_df(sku_filter: Optional[str] = None, reason: Optional[str] = None, days: Optional[int] = None) -> pd.DataFrame:
-    con = get_conn()
+def stock_value_positive_df(filter_text: Optional[str] = None, categoria: str = "", subtipo: str = "") -> pd.DataFrame:
+    """Retorna apenas itens com estoque positivo para cálculo de valor total"""
+    return _cached_stock_value_positive(_db_version(), filter_text, categoria, subtipo)
+
+def _category_conds(categoria: str, subtipo: str, prefix: str = "") -> Tuple[List[str], list]:
+    """Condições SQL do filtro por trecho de categoria/subtipo (sem diferenciar maiúsculas)"""
+    conds, params = [], []
+    for col, trecho in (("category", categoria), ("subtype", subtipo)):
+        if trecho:
+            conds.append(f"instr(casefold({prefix}{col}), ?) > 0")
+            params.append(trecho.casefold())
+    return conds, params
+
+# Janela por "days" depende do relógio: ttl evita que ela congele sem escritas
+@st.cache_data(show_spinner=False, ttl=300, max_entries=LOADER_CACHE_MAX)
+def _cached_movements(version: Tuple[float, int], sku_filter: Optional[str], reason: Optional[str], days: Optional[int]) -> pd.DataFrame:
+    con = get_read_conn()
     sql = """
         SELECT m.id, v.sku, p.category AS categoria, p.subtype AS subtipo, v.color AS cor, v.size AS tamanho,
                m.qty AS quantidade, m.reason AS motivo, m.ts AS quando
@@ -481,8 +894,12 @@ def movements_df(sku_filter: Optional[str] = None, reason: Optional[str] = None,
     sql += " ORDER BY m.ts DESC"
     return pd.read_sql_query(sql, con, params=params)
 
-def get_sales_data(days: Optional[int] = None) -> pd.DataFrame:
-    con = get_conn()
+def movements_df(sku_filter: Optional[str] = None, reason: Optional[str] = None, days: Optional[int] = None) -> pd.DataFrame:
+    return _cached_movements(_db_version(), sku_filter, reason, days)
+
+@st.cache_data(show_spinner=False, ttl=300, max_entries=LOADER_CACHE_MAX)
+def _cached_sales(version: Tuple[float, int], days: Optional[int], categoria: str, subtipo: str) -> pd.DataFrame:
+    con = get_read_conn()
     sql = """
         SELECT p.category, p.subtype, v.color, v.size, ABS(SUM(m.qty)) as quantidade_vendida,
                COUNT(*) as numero_vendas, COALESCE(v.custo_unitario, p.custo_unitario, 0) as custo_unitario,
@@ -490,194 +907,317 @@ def get_sales_data(days: Optional[int] = None) -> pd.DataFrame:
         FROM movements m JOIN variants v ON v.id = m.variant_id JOIN products p ON p.id = v.product_id
         WHERE m.reason IN ('venda', 'venda_pdf')
     """
-    params = []
+    conds, params = _category_conds(categoria, subtipo, "p.")
+    for cond in conds:
+        sql += " AND " + cond
     if days:
         ts_min = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec="seconds")
         sql += " AND m.ts >= ?"
         params.append(ts_min)
     sql += " GROUP BY p.category, p.subtype, v.color, v.size ORDER BY quantidade_vendida DESC"
-    return pd.read_sql_query(sql, con, params=params)
+    return pd.read_sql_query(sql, con, params=params, dtype=_GROUP_DTYPES)
+
+def get_sales_data(days: Optional[int] = None, categoria: str = "", subtipo: str = "") -> pd.DataFrame:
+    return _cached_sales(_db_version(), days, categoria, subtipo)
+
+def stock_value_by_category(categoria: str = "", subtipo: str = "") -> pd.DataFrame:
+    """Valor do estoque (só positivos) agrupado por categoria/subtipo (a partir do stock_value_positive_df em cache)"""
+    df = stock_value_positive_df(categoria=categoria, subtipo=subtipo)
+    return df.groupby(['category', 'subtype'], sort=False, observed=True).agg({
+        'estoque': 'sum',
+        'valor_estoque': 'sum',
+        'sku': 'count'
+    }).reset_index().rename(columns={'sku':'quantidade_skus','estoque':'total_unidades'}).sort_values('valor_estoque', ascending=False)
+
+@st.cache_data(show_spinner=False, ttl=300, max_entries=LOADER_CACHE_MAX)
+def _cached_sales_rollups(version: Tuple[float, int], days: Optional[int], categoria: str, subtipo: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # get_sales_data já vem agregado por categoria/subtipo/cor/tamanho: os rankings só somam esse resultado
+    df_prod = get_sales_data(days, categoria, subtipo)
+    cols = ["quantidade_vendida", "valor_total_vendido"]
+    df_top = (
+        df_prod.groupby(["category", "subtype"], as_index=False, sort=False, observed=True)[cols]
+        .sum()
+        .assign(produto=lambda d: d["category"].astype(str) + " - " + d["subtype"].astype(str))
+        .sort_values("quantidade_vendida", ascending=False)
+    )
+    df_tam = (
+        df_prod.groupby("size", as_index=False, sort=False, observed=True)[cols]
+        .sum().nlargest(30, "quantidade_vendida")
+    )
+    df_itens = (
+        df_prod
+        .assign(
+            # Uma só passada de upper/regex sobre categoria-subtipo-cor; o tamanho entra sem trocar espaços
+            item=lambda d: (
+                d["category"].astype(str)
+                .str.cat([d["subtype"].astype(str), d["color"].astype(str)], sep="-")
+                .str.upper().str.replace(_WS_RE, "-", regex=True)
+                .str.cat(d["size"].astype(str).str.upper(), sep="-")
+            )
+        )
+        .groupby("item", as_index=False, sort=False)[cols]
+        .sum().sort_values("quantidade_vendida", ascending=False)
+    )
+    return df_top, df_tam, df_itens
+
+def sales_rollups(days: Optional[int] = None, categoria: str = "", subtipo: str = "") -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Rankings do Gráfico de Vendas: produtos (categoria-subtipo), top 30 tamanhos e itens (categoria-subtipo-cor-tamanho)"""
+    return _cached_sales_rollups(_db_version(), days, categoria, subtipo)
+
+@st.cache_data(show_spinner=False, ttl=300, max_entries=LOADER_CACHE_MAX)
+def _cached_sales_by_category(version: Tuple[float, int], days: Optional[int]) -> pd.DataFrame:
+    return (
+        get_sales_data(days)
+        .groupby("category", sort=False, observed=True)
+        .agg({"quantidade_vendida": "sum", "valor_total_vendido": "sum"})
+        .reset_index().sort_values("quantidade_vendida", ascending=False)
+    )
+
+def sales_by_category(days: Optional[int] = None) -> pd.DataFrame:
+    """Vendas do período por categoria (sem filtros), para as pizzas do Gráfico de Vendas"""
+    return _cached_sales_by_category(_db_version(), days)
+
+def csv_bytes(df: pd.DataFrame) -> bytes:
+    """DataFrame -> CSV UTF-8 (mesmo formato do to_csv de sempre)"""
+    # Escreve direto em bytes, sem a string intermediária de to_csv() + encode()
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=LOADER_CACHE_MAX)
+def cached_csv_bytes(df: pd.DataFrame) -> bytes:
+    """csv_bytes em cache pelo conteúdo do DataFrame: botões de download não reserializam a cada rerun"""
+    return csv_bytes(df)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def export_csv(version: Tuple[float, int], kind: str) -> bytes:
+    """CSV da tela Exportar ('variantes', 'estoque' ou 'movimentacoes')"""
+    loaders = {"variantes": list_variants_df, "estoque": stock_df, "movimentacoes": movements_df}
+    return csv_bytes(loaders[kind]())
 
 # ==========================================
 # SKU Mapping helpers
 # ==========================================
-def get_sku_mapping(sku_pdf_norm: str) -> Optional[str]:
-    key_pdf = sanitize_sku(sku_pdf_norm)
-    con = get_conn()
-    cur = con.cursor()
+def _variants_sku_index() -> Dict[str, str]:
+    """Índice normalize_key(sku) -> sku direto da tabela, sem montar DataFrame"""
+    # Mesma ordem do list_variants_df: em colisão de normalize_key, o último SKU nessa ordem vence
+    rows = get_read_conn().execute(
+        "SELECT v.sku FROM variants v JOIN products p ON p.id = v.product_id "
+        "ORDER BY p.category, p.subtype, v.color, v.size"
+    )
+    return {normalize_key(r[0]): r[0] for r in rows}
+
+# cache_resource (sem cópia): os mapas são só leitura e consultados a cada linha do PDF
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _sku_lookup_maps(version: Tuple[float, int]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Mapas de resolução: sku_mapping sanitizado e índice normalizado dos SKUs de variantes"""
+    con = get_read_conn()
     try:
-        rows = cur.execute("SELECT sku_pdf, sku_estoque FROM sku_mapping").fetchall()
-        map1 = {sanitize_sku(k): v for (k, v) in rows}
-        if key_pdf in map1:
-            return map1[key_pdf]
+        rows = con.execute("SELECT sku_pdf, sku_estoque FROM sku_mapping").fetchall()
     except sqlite3.OperationalError:
-        pass
-    vdf = list_variants_df()
-    norm_index = {normalize_key(sku): sku for sku in vdf["sku"].tolist()}
-    cand = norm_index.get(normalize_key(key_pdf))
-    return cand
+        rows = []
+    pdf_map = {sanitize_sku(k): v for (k, v) in rows}
+    variant_norm = _variants_sku_index()
+    return pdf_map, variant_norm
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _baixa_maps(version: Tuple[float, int]) -> Tuple[Dict[str, str], pd.Series, frozenset]:
+    """Mapas da conferência da baixa: SKU sanitizado -> original, saldo indexado por SKU e SKUs sanitizados (só leitura)"""
+    estoque = stock_df()
+    estoque_series = estoque["estoque"].astype(int).set_axis(estoque["sku"].astype(str))
+    sku_san_to_orig = sanitized_to_original_sku_map()
+    return sku_san_to_orig, estoque_series, frozenset(sku_san_to_orig)
+
+def get_sku_mapping(sku_pdf_norm: str, maps: Optional[Tuple[Dict[str, str], Dict[str, str]]] = None) -> Optional[str]:
+    key_pdf = sanitize_sku(sku_pdf_norm)
+    pdf_map, variant_norm = maps or _sku_lookup_maps(_db_version())
+    if key_pdf in pdf_map:
+        return pdf_map[key_pdf]
+    return variant_norm.get(normalize_key(key_pdf))
 
 # ==========================================
 # PDF Parser
 # ==========================================
-def processar_pdf_vendas(pdf_file) -> Tuple[bool, List[dict], str]:
-    try:
-        # Tenta importar pypdf primeiro
+_SKIP_RE = re.compile("|".join([
+    r"^LISTA DE RESUMO", r"^\(PRODUTOS DO ARMAZ[EÉ]M\)", r"^PRODUTOS DO ARMAZ[EÉ]M",
+    r"^VARIA[CÇ][AÃ]O$", r"^SKU DE PRODUTO$", r"^QTD\.?$", r"^IMPRIMIR.*UPSELLER",
+    r"^HTTPS?://", r"^\d+/\d+$", r"^\d{1,2}/\d{1,2}/\d{4}", r"^QTD\. DE PEDIDOS",
+    r"^N[ÚU]MERO DE SKUS DE PRODUTOS", r"^TOTAL DE PRODUTOS",
+]), re.IGNORECASE)
+
+_SIZE_ALT = r"XGG|GG|XG|PP|G|M|P|\d{1,3}"
+_SIZE = rf"(?:{_SIZE_ALT})"
+# O tamanho é o último elemento obrigatório do token: grupo atômico (Python 3.11+)
+# corta o retrocesso dentro da alternância sem mudar o que casa
+_SIZE_ATOMIC = rf"(?>{_SIZE_ALT})" if sys.version_info >= (3, 11) else _SIZE
+_TOKEN = (
+    r"(?:[A-Z]{2,}(?:-[A-Z]{2,}){0,2})"
+    r"-(?:[A-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]+)"
+    r"(?:-[A-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]+)?"
+    r"-" + _SIZE_ATOMIC
+)
+_SKU_PATTERN = re.compile(rf"({_TOKEN})(\d{{1,3}})?", re.UNICODE)
+_PREFACE_SIZE_START = re.compile(rf"^(?:{_SIZE})(?=(?:[A-Z]{{2,}}(?:-[A-Z]{{2,}}){{0,2}})-)")
+_PREFACE_SIZE_AFTER_COMMA = re.compile(rf",(?:{_SIZE})(?=(?:[A-Z]{{2,}}(?:-[A-Z]{{2,}}){{0,2}})-)")
+_SIZE_SUFFIX_RE = re.compile(rf"^(.*-)(XGG|GG|XG|PP|G|M|P|\d{{1,3}})$")
+_WS_RE = re.compile(r"\s+")
+_DASH_RE = re.compile(r"-{2,}")
+_DIGITS_3 = re.compile(r"\d{3}")
+_QTY_RE = re.compile(r"\d{1,3}")
+_SIZE_QTY_TAIL_RE = re.compile(rf"(?:{_SIZE})?(\d{{1,3}})")
+_PAGE_COUNTER_RE = re.compile(r"\s+\d+/\d+\s*$")
+_RECOGNIZED_SIZES = frozenset({'2','4','6','8','10','12','14','16','P','M','G','GG','PP','XG','XGG'})
+
+def _split_size_qty(size_part: str) -> Tuple[str, str]:
+    """Separa tamanho grudado na quantidade: '121' -> ('12', '1'), '35' -> ('3', '5')"""
+    take = ""
+    s = size_part
+    while len(s) > 1 and s not in _RECOGNIZED_SIZES:
+        take = s[-1] + take
+        s = s[:-1]
+    return s, take
+
+# Tabela pronta para todo sufixo de 2-3 dígitos que não é tamanho conhecido
+_SIZE_QTY_SPLIT = {
+    d: _split_size_qty(d)
+    for n in (2, 3) for d in (str(i).zfill(n) for i in range(10 ** n))
+    if d not in _RECOGNIZED_SIZES
+}
+
+def _norm(s: str) -> str:
+    s = s.upper()
+    s = _WS_RE.sub("", s)
+    s = _DASH_RE.sub("-", s)
+    return s
+
+def _maybe_int(txt: str, next_char: Optional[str] = None) -> Optional[int]:
+    if txt is None:
+        return None
+    if not _QTY_RE.fullmatch(txt):
+        return None
+    if next_char == "/":
+        return int(txt[0])
+    return int(txt)
+
+# Leitor de texto do PDF: pypdf por padrão (as regex da varredura foram ajustadas
+# no layout dele). PyMuPDF só com ESTOQUE_PDF_BACKEND=pymupdf e o fitz instalado.
+PDF_TEXT_BACKEND = os.environ.get("ESTOQUE_PDF_BACKEND", "pypdf").strip().lower()
+
+def _pdf_page_texts(pdf_file) -> Iterator[str]:
+    """Texto de cada página: pypdf/PyPDF2, ou PyMuPDF (fitz) se PDF_TEXT_BACKEND pedir"""
+    fitz = None
+    if PDF_TEXT_BACKEND == "pymupdf":
         try:
-            import pypdf as PyPDF2
+            import fitz
         except ImportError:
-            import PyPDF2
-            
-        reader = PyPDF2.PdfReader(pdf_file)
-        raw = ""
-        for p in reader.pages:
-            raw += (p.extract_text() or "") + "\n"
-        
-        # Resto do código do parser PDF permanece EXATAMENTE igual
-        lines = [ln.strip() for ln in raw.replace("\r", "\n").split("\n")]
-        lines = [ln for ln in lines if ln]
-        lines = [re.sub(r"\s+\d+/\d+\s*$", "", ln) for ln in lines]
-        
-        skip_re = re.compile("|".join([
-            r"^LISTA DE RESUMO", r"^\(PRODUTOS DO ARMAZ[EÉ]M\)", r"^PRODUTOS DO ARMAZ[EÉ]M",
-            r"^VARIA[CÇ][AÃ]O$", r"^SKU DE PRODUTO$", r"^QTD\.?$", r"^IMPRIMIR.*UPSELLER",
-            r"^HTTPS?://", r"^\d+/\d+$", r"^\d{1,2}/\d{1,2}/\d{4}", r"^QTD\. DE PEDIDOS",
-            r"^N[ÚU]MERO DE SKUS DE PRODUTOS", r"^TOTAL DE PRODUTOS",
-        ]), re.IGNORECASE)
+            fitz = None
+    if fitz is not None:
+        pdf_file.seek(0)
+        with fitz.open(stream=pdf_file.read(), filetype="pdf") as doc:
+            for page in doc:
+                yield page.get_text("text")
+        return
+    
+    # Tenta importar pypdf primeiro
+    try:
+        import pypdf as PyPDF2
+    except ImportError:
+        import PyPDF2
+    reader = PyPDF2.PdfReader(pdf_file)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+def _iter_lines(page_texts: Iterable[str]) -> Iterator[str]:
+    """Linhas não vazias do PDF, sem o sufixo de paginação ('... 1/3')"""
+    for text in page_texts:
+        for ln in text.replace("\r", "\n").split("\n"):
+            ln = ln.strip()
+            if ln:
+                yield _PAGE_COUNTER_RE.sub("", ln)
+
+def _merge_hyphenated(lines: Iterable[str]) -> Iterator[str]:
+    """Junta linhas terminadas em '-' com as seguintes (SKU quebrado) em uma só passada"""
+    buf: List[str] = []
+    for ln in lines:
+        buf.append(ln)
+        if not ln.endswith("-"):
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+def _scan_hits(lines: Iterable[str]) -> Iterator[Tuple[str, int]]:
+    """Varre as linhas já juntadas e produz (sku, qtd) na ordem de leitura"""
+    # Os tokens são fatias de `compact`, que já passou por _norm: não renormalizar
+    pending_sku: Optional[str] = None
+    
+    for ln in lines:
+        compact = _norm(ln)
+        compact = _PREFACE_SIZE_START.sub("", compact)
+        compact = _PREFACE_SIZE_AFTER_COMMA.sub(",", compact)
+        last_end = 0
         
-        kept = [ln for ln in lines if not skip_re.search(ln)]
-        merged = []
-        i = 0
-        while i < len(kept):
-            cur = kept[i]
-            if cur.endswith("-") and i + 1 < len(kept):
-                cur = cur + kept[i + 1]
-                i += 2
-                while cur.endswith("-") and i < len(kept):
-                    cur = cur + kept[i]
-                    i += 1
-                merged.append(cur)
+        for m in _SKU_PATTERN.finditer(compact):
+            token = m.group(1)
+            qty_str = m.group(2)
+            token_out = token
+            ms = _SIZE_SUFFIX_RE.match(token)
+            if ms:
+                size_part = ms.group(2)
+                split = _SIZE_QTY_SPLIT.get(size_part) if qty_str is None else None
+                if split:
+                    s, qty_str = split
+                    token_out = ms.group(1) + s
+                if qty_str is None and _DIGITS_3.fullmatch(size_part):
+                    token_out = ms.group(1) + size_part[:2]
+                    qty_str = size_part[2:]
+            
+            next_char = compact[m.end(2)] if (m.end(2) < len(compact) if qty_str else False) else (compact[m.end(1)] if (m.end(1) < len(compact)) else None)
+            qty_val = _maybe_int(qty_str, next_char) if qty_str else None
+            
+            if qty_val is not None:
+                yield token_out, int(qty_val)
+                pending_sku = None
             else:
-                merged.append(cur)
-                i += 1
+                pending_sku = token_out
+            last_end = m.end()
         
-        SIZE = r"(?:XGG|GG|XG|PP|G|M|P|\d{1,3})"
-        TOKEN = (
-            r"(?:[A-Z]{2,}(?:-[A-Z]{2,}){0,2})"
-            r"-(?:[A-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]+)"
-            r"(?:-[A-Z0-9ÁÀÂÃÉÈÊÍÌÎÓÒÔÕÚÙÛÇ]+)?"
-            r"-" + SIZE
-        )
-        sku_pattern = re.compile(rf"({TOKEN})(\d{{1,3}})?", re.UNICODE)
-        preface_size_start = re.compile(rf"^(?:{SIZE})(?=(?:[A-Z]{{2,}}(?:-[A-Z]{{2,}}){{0,2}})-)")
-        preface_size_after_comma = re.compile(rf",(?:{SIZE})(?=(?:[A-Z]{{2,}}(?:-[A-Z]{{2,}}){{0,2}})-)")
-        size_suffix_re = re.compile(rf"^(.*-)(XGG|GG|XG|PP|G|M|P|\d{{1,3}})$")
-        recognized_sizes = {'2','4','6','8','10','12','14','16','P','M','G','GG','PP','XG','XGG'}
-        
-        def norm(s: str) -> str:
-            s = s.upper()
-            s = re.sub(r"\s+", "", s)
-            s = re.sub(r"-{2,}", "-", s)
-            return s
+        if pending_sku:
+            tail = compact[last_end:]
+            if _QTY_RE.fullmatch(tail):
+                q = _maybe_int(tail, None)
+                if q is not None:
+                    yield pending_sku, int(q)
+                    pending_sku = None
+            else:
+                m2 = _SIZE_QTY_TAIL_RE.fullmatch(tail)
+                if m2:
+                    q = int(m2.group(1))
+                    yield pending_sku, q
+                    pending_sku = None
+
+def processar_pdf_vendas(pdf_file) -> Tuple[bool, List[dict], str]:
+    try:
+        # Página a página: linhas são filtradas/juntadas sem montar o texto inteiro
+        kept = (ln for ln in _iter_lines(_pdf_page_texts(pdf_file)) if not _SKIP_RE.search(ln))
+        merged = _merge_hyphenated(kept)
         
-        def maybe_int(txt: str, next_char: Optional[str] = None) -> Optional[int]:
-            if txt is None:
-                return None
-            if not re.fullmatch(r"\d{1,3}", txt):
-                return None
-            if next_char == "/":
-                return int(txt[0])
-            return int(txt)
+        # (sku, qtd) na ordem de leitura; o dict descarta repetidos sem consultar o banco
+        raw_hits = dict.fromkeys(_scan_hits(merged))
         
+        # Resolve os mapeamentos uma única vez, depois da varredura
+        maps = _sku_lookup_maps(_db_version())
         movimentos: List[dict] = []
-        vistos: set = set()
-        pending_sku: Optional[str] = None
-        
-        for ln in merged:
-            compact = norm(ln)
-            compact = preface_size_start.sub("", compact)
-            compact = preface_size_after_comma.sub(",", compact)
-            last_end = 0
-            
-            for m in sku_pattern.finditer(compact):
-                token = m.group(1)
-                qty_str = m.group(2)
-                token_out = token
-                ms = size_suffix_re.match(token)
-                if ms:
-                    size_part = ms.group(2)
-                    if qty_str is None and re.fullmatch(r"\d{2,3}", size_part) and size_part not in recognized_sizes:
-                        take = ""
-                        s = size_part
-                        while len(s) > 1 and s not in recognized_sizes:
-                            take = s[-1] + take
-                            s = s[:-1]
-                        if take:
-                            qty_str = take
-                            token_out = ms.group(1) + s
-                    if qty_str is None and re.fullmatch(r"\d{3}", size_part):
-                        token_out = ms.group(1) + size_part[:2]
-                        qty_str = size_part[2:]
-                
-                next_char = compact[m.end(2)] if (m.end(2) < len(compact) if qty_str else False) else (compact[m.end(1)] if (m.end(1) < len(compact)) else None)
-                qty_val = maybe_int(qty_str, next_char) if qty_str else None
-                
-                if qty_val is not None:
-                    sku_n = norm(token_out)
-                    key = (sku_n, qty_val)
-                    if key not in vistos:
-                        vistos.add(key)
-                        mapped = get_sku_mapping(sku_n)
-                        movimentos.append({
-                            "sku_pdf": sku_n,
-                            "sku": mapped or sku_n,
-                            "quantidade": int(qty_val),
-                            "produto": "Extraído do PDF",
-                            "variacao": "Extraído do PDF",
-                            "mapeado": bool(mapped),
-                        })
-                    pending_sku = None
-                else:
-                    pending_sku = token_out
-                last_end = m.end()
-            
-            if pending_sku:
-                tail = compact[last_end:]
-                if re.fullmatch(r"\d{1,3}", tail or ""):
-                    q = maybe_int(tail, None)
-                    if q is not None:
-                        sku_n = norm(pending_sku)
-                        key = (sku_n, q)
-                        if key not in vistos:
-                            vistos.add(key)
-                            mapped = get_sku_mapping(sku_n)
-                            movimentos.append({
-                                "sku_pdf": sku_n,
-                                "sku": mapped or sku_n,
-                                "quantidade": int(q),
-                                "produto": "Extraído do PDF",
-                                "variacao": "Extraído do PDF",
-                                "mapeado": bool(mapped),
-                            })
-                        pending_sku = None
-                else:
-                    m2 = re.fullmatch(rf"(?:{SIZE})?(\d{{1,3}})", tail or "")
-                    if m2:
-                        q = int(m2.group(1))
-                        sku_n = norm(pending_sku)
-                        key = (sku_n, q)
-                        if key not in vistos:
-                            vistos.add(key)
-                            mapped = get_sku_mapping(sku_n)
-                            movimentos.append({
-                                "sku_pdf": sku_n,
-                                "sku": mapped or sku_n,
-                                "quantidade": int(q),
-                                "produto": "Extraído do PDF",
-                                "variacao": "Extraído do PDF",
-                                "mapeado": bool(mapped),
-                            })
-                        pending_sku = None
+        for sku_n, q in raw_hits:
+            mapped = get_sku_mapping(sku_n, maps)
+            movimentos.append({
+                "sku_pdf": sku_n,
+                "sku": mapped or sku_n,
+                "quantidade": q,
+                "produto": "Extraído do PDF",
+                "variacao": "Extraído do PDF",
+                "mapeado": bool(mapped),
+            })
         
         if not movimentos:
             return False, [], "Nenhum item encontrado no PDF."
@@ -689,11 +1229,64 @@ def processar_pdf_vendas(pdf_file) -> Tuple[bool, List[dict], str]:
         st.error(f"Erro detalhado: {traceback.format_exc()}")
         return False, [], f"Erro ao processar PDF: {str(e)}"
 
+PDF_CACHE_MAX = 32  # PDFs lidos guardados em cache
+
+class _PdfParseFailed(Exception):
+    """Leitura sem sucesso: sai do cache como exceção, então a falha não fica guardada"""
+    def __init__(self, result: Tuple[bool, List[dict], str]):
+        super().__init__(result[2])
+        self.result = result
+
+@st.cache_data(max_entries=PDF_CACHE_MAX, show_spinner="Lendo PDF…")
+def _cached_pdf_parse(version, digest: str, _pdf_file) -> Tuple[bool, List[dict], str]:
+    """Leitura do PDF em cache pelo conteúdo (digest) + versão do banco (os mapeamentos dependem dela)"""
+    _pdf_file.seek(0)
+    result = processar_pdf_vendas(_pdf_file)
+    if not result[0]:
+        raise _PdfParseFailed(result)
+    return result
+
+def processar_pdf_cached(pdf_file) -> Tuple[bool, List[dict], str]:
+    """processar_pdf_vendas sem reler o mesmo arquivo a cada rerun (chave: sha1 + versão do banco; falhas não são guardadas)"""
+    # getbuffer() expõe o conteúdo do upload sem copiar os bytes
+    digest = hashlib.sha1(pdf_file.getbuffer()).hexdigest()
+    try:
+        return _cached_pdf_parse(_db_version(), digest, pdf_file)
+    except _PdfParseFailed as e:
+        return e.result
+
 # ==========================================
 # UI START - CÓDIGO COMPLETO
 # ==========================================
-init_db()
-migrate_db()
+@st.cache_resource(show_spinner=False)
+def _bootstrap() -> bool:
+    """Cria e migra o schema uma vez por processo (não a cada rerun)"""
+    init_db()
+    migrate_db()
+    return True
+
+# A sessão só consulta o cache do bootstrap na primeira execução
+if not st.session_state.get("schema_ok"):
+    _bootstrap()
+    st.session_state["schema_ok"] = True
+
+PAGES: Tuple[str, ...] = (
+    "Cadastrar Tipo/Subtipo",
+    "Cadastrar Variante",
+    "Movimentar Estoque",
+    "Baixa por PDF",
+    "Estoque Atual",
+    "Histórico",
+    "Exportar CSV",
+    "Editar Variante",
+    "Remover Variante",
+    "Mapeamento de SKUs",
+    "Gerenciar SKU Base",
+    "Custo por Categoria/Subtipo (em massa)",
+    "Contagem de Estoque",
+    "Valor do Estoque",
+    "Gráfico de Vendas",
+)
 
 st.title("📦 Controle de Estoque — JIOR BLANC")
 st.caption("Cadastre produtos, variantes e registre entradas/saídas com histórico e exportação de CSV.")
@@ -704,58 +1297,70 @@ st.sidebar.success("✅ SQLite Persistente - Dados Salvos")
 # ------------- Sidebar -------------
 with st.sidebar:
     st.header("Navegação")
-    page = st.radio(
-        "Ir para:",
-        [
-            "Cadastrar Tipo/Subtipo",
-            "Cadastrar Variante", 
-            "Movimentar Estoque",
-            "Baixa por PDF",
-            "Estoque Atual",
-            "Histórico",
-            "Exportar CSV",
-            "Editar Variante",
-            "Remover Variante",
-            "Mapeamento de SKUs",
-            "Gerenciar SKU Base",
-            "Custo por Categoria/Subtipo (em massa)",
-            "Contagem de Estoque",
-            "Valor do Estoque",
-            "Gráfico de Vendas",
-        ],
-        index=3,
-    )
+    # Página ativa também na URL (?page=...): recarregar/compartilhar o link mantém a tela
+    query_params = getattr(st, "query_params", None)  # Streamlit >= 1.30
+    if "page" not in st.session_state:
+        url_page = query_params.get("page") if query_params is not None else None
+        st.session_state["page"] = url_page if url_page in PAGES else PAGES[3]
+    page = st.radio("Ir para:", PAGES, key="page")
+    if query_params is not None and query_params.get("page") != page:
+        query_params["page"] = page
     
     st.divider()
     st.markdown("**Dica:** nos selects, digite para filtrar o SKU (autocomplete).")
     
     if st.button("🔄 Forçar Migração do Banco"):
+        # Fora do cache do _bootstrap: roda de verdade a cada clique
         migrate_db()
         st.success("Migração executada com sucesso!")
         st.rerun()
     
     if st.button("💾 Criar Backup Agora"):
-        backup_path = backup_database()
-        st.success(f"Backup criado: {os.path.basename(backup_path)}")
+        _, backup_name = _manual_backup(int(time.time() // MANUAL_BACKUP_WINDOW))
+        st.success(f"Backup criado: {backup_name}")
 
 # ==========================================
 # PÁGINAS COMPLETAS
 # ==========================================
+# Cada página é um fragmento (Streamlit >= 1.37): interações dentro dela não
+# reexecutam título/sidebar. Versões antigas rodam a página normalmente.
+_fragment = getattr(st, "fragment", lambda func: func)
+
+def _row_styles(frame: pd.DataFrame, row_css: np.ndarray) -> pd.DataFrame:
+    """Estilo por linha para Styler.apply(axis=None): repete o CSS de cada linha em todas as colunas"""
+    return pd.DataFrame(
+        np.repeat(np.asarray(row_css, dtype=object)[:, None], frame.shape[1], axis=1),
+        index=frame.index, columns=frame.columns,
+    )
+
+def _hbar_pair(df: pd.DataFrame, y: str, bars: List[Tuple[str, str, str]], horizontal_spacing: float = 0.2):
+    """Duas barras horizontais lado a lado numa só figura (um payload só); bars = [(coluna x, título, rótulo x)]"""
+    from plotly.subplots import make_subplots  # plotly só é carregado pela página de vendas
+    fig = make_subplots(rows=1, cols=len(bars), subplot_titles=[t for _, t, _ in bars],
+                        horizontal_spacing=horizontal_spacing)
+    for col, (x, _, x_label) in enumerate(bars, start=1):
+        fig.add_bar(x=df[x], y=df[y], orientation="h", name=x_label, showlegend=False, row=1, col=col)
+        fig.update_xaxes(title_text=x_label, row=1, col=col)
+        fig.update_yaxes(categoryorder="total ascending", row=1, col=col)
+    return fig
 
 # -------- Cadastrar Tipo/Subtipo --------
-if page == "Cadastrar Tipo/Subtipo":
+@_fragment
+def _page_cadastrar_tipo() -> None:
     st.subheader("Cadastrar novo tipo de produto")
-    col1, col2, col3, col4 = st.columns([2, 2, 2, 2])
-    with col1:
-        category = st.text_input("Categoria (ex.: short, camiseta, moletom)")
-    with col2:
-        subtype = st.text_input("Subtipo (ex.: tactel, dryfit, algodão, canguru, careca)")
-    with col3:
-        sku_base = st.text_input("SKU Base (ex.: MOL-CARECA)", help="Usado para gerar SKUs automaticamente: SKUBASE-Cor-Tamanho")
-    with col4:
-        custo_unitario = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=0.0, step=0.01, help="Custo padrão para este tipo/subtipo")
+    with st.form("cad_tipo"):
+        col1, col2, col3, col4 = st.columns([2, 2, 2, 2])
+        with col1:
+            category = st.text_input("Categoria (ex.: short, camiseta, moletom)")
+        with col2:
+            subtype = st.text_input("Subtipo (ex.: tactel, dryfit, algodão, canguru, careca)")
+        with col3:
+            sku_base = st.text_input("SKU Base (ex.: MOL-CARECA)", help="Usado para gerar SKUs automaticamente: SKUBASE-Cor-Tamanho")
+        with col4:
+            custo_unitario = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=0.0, step=0.01, help="Custo padrão para este tipo/subtipo")
+        submitted = st.form_submit_button("Salvar tipo/subtipo", type="primary")
     
-    if st.button("Salvar tipo/subtipo", type="primary"):
+    if submitted:
         if not category or not subtype:
             st.error("Preencha categoria e subtipo.")
         else:
@@ -770,25 +1375,28 @@ if page == "Cadastrar Tipo/Subtipo":
     st.dataframe(list_products_df(), use_container_width=True)
 
 # -------- Cadastrar Variante --------
-elif page == "Cadastrar Variante":
+@_fragment
+def _page_cadastrar_variante() -> None:
     st.subheader("Cadastrar nova variante")
-    col1, col2, col3, col4, col5 = st.columns([2,2,2,2,2])
-    with col1:
-        category = st.text_input("Categoria")
-    with col2:
-        subtype = st.text_input("Subtipo")
-    with col3:
-        color = st.text_input("Cor")
-    with col4:
-        size = st.text_input("Tamanho")
-    with col5:
-        sku_base = st.text_input("SKU Base (opcional — se vazio, usa SKU Base do produto)")
-    
-    custo_unitario_produto = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=0.0, step=0.01, help="Define/atualiza o custo padrão do produto (categoria/subtipo)")
-    custo_unitario_variante = st.number_input("Custo Unitário (VARIANTE) R$ (opcional)", min_value=0.0, value=0.0, step=0.01, help="Se informado > 0, esta variante usará este custo (não afeta as outras)")
-    sku_override = st.text_input("SKU (opcional — para sobrepor)")
+    with st.form("cad_variante"):
+        col1, col2, col3, col4, col5 = st.columns([2,2,2,2,2])
+        with col1:
+            category = st.text_input("Categoria")
+        with col2:
+            subtype = st.text_input("Subtipo")
+        with col3:
+            color = st.text_input("Cor")
+        with col4:
+            size = st.text_input("Tamanho")
+        with col5:
+            sku_base = st.text_input("SKU Base (opcional — se vazio, usa SKU Base do produto)")
+        
+        custo_unitario_produto = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=0.0, step=0.01, help="Define/atualiza o custo padrão do produto (categoria/subtipo)")
+        custo_unitario_variante = st.number_input("Custo Unitário (VARIANTE) R$ (opcional)", min_value=0.0, value=0.0, step=0.01, help="Se informado > 0, esta variante usará este custo (não afeta as outras)")
+        sku_override = st.text_input("SKU (opcional — para sobrepor)")
+        submitted = st.form_submit_button("Criar variante", type="primary")
     
-    if st.button("Criar variante", type="primary"):
+    if submitted:
         cvar = custo_unitario_variante if custo_unitario_variante > 0 else None
         ok, msg = create_variant(category, subtype, color, size, sku_base, sku_override, custo_unitario_produto, cvar)
         if ok:
@@ -797,19 +1405,14 @@ elif page == "Cadastrar Variante":
             st.error(msg)
 
 # -------- Movimentar Estoque (saldo antes/depois) --------
-elif page == "Movimentar Estoque":
+@_fragment
+def _page_movimentar() -> None:
     st.subheader("Movimentar Estoque")
-    vdf = list_variants_df()
-    sku_options = vdf["sku"].tolist()
-    sku = st.selectbox("SKU (digite para filtrar)", sku_options, index=None, placeholder="Digite parte do SKU…")
+    sku = st.selectbox("SKU (digite para filtrar)", list_variant_skus(), index=None, placeholder="Digite parte do SKU…")
     
     estoque_atual = None
     if sku:
-        df_sku = stock_df(filter_text=sku)
-        try:
-            estoque_atual = int(df_sku.loc[df_sku["sku"] == sku, "estoque"].values[0])
-        except Exception:
-            estoque_atual = 0
+        estoque_atual = stock_for_sku(sku)
         st.metric("Estoque atual", estoque_atual)
     
     qtd_input = st.number_input("Quantidade", value=1, step=1, min_value=1)
@@ -850,11 +1453,8 @@ elif page == "Movimentar Estoque":
                     st.info(f"**Ajustado:** Vendendo apenas {estoque_atual} unidades (estoque disponível)")
                 
                 record_movement(sku, int(quantidade_a_registrar), reason)
-                novo_df_sku = stock_df(filter_text=sku)
-                try:
-                    novo_estoque = int(novo_df_sku.loc[novo_df_sku["sku"] == sku, "estoque"].values[0])
-                except Exception:
-                    novo_estoque = (estoque_atual or 0) + int(quantidade_a_registrar)
+                # Saldo novo = anterior + movimento (sem reconsultar o banco)
+                novo_estoque = (estoque_atual or 0) + int(quantidade_a_registrar)
                 
                 if faltara > 0:
                     st.success(
@@ -871,26 +1471,30 @@ elif page == "Movimentar Estoque":
                 st.error(str(e))
 
 # -------- Baixa por PDF (usa processar_pdf_vendas) --------
-# -------- Baixa por PDF (usa processar_pdf_vendas) --------
-elif page == "Baixa por PDF":
+PDF_PREVIEW_COLUMNS = ["sku_pdf", "sku", "quantidade", "mapeado", "produto", "variacao"]
+PDF_PREVIEW_DTYPES = {
+    "sku_pdf": "string", "sku": "string", "quantidade": "int32",
+    "mapeado": "bool", "produto": "string", "variacao": "string",
+}
+
+@_fragment
+def _page_baixa_pdf() -> None:
     st.subheader("Baixa por PDF (layout UpSeller)")
     st.caption("Envie o PDF como o do UpSeller. O sistema identifica SKU e quantidade, mapeia e aplica as baixas.")
     
     up = st.file_uploader("Selecionar PDF", type=["pdf"])
     if up is not None:
-        file_bytes = up.read()
-        ok, movimentos, msg = processar_pdf_vendas(io.BytesIO(file_bytes))
+        ok, movimentos, msg = processar_pdf_cached(up)
         
         if not ok or not movimentos:
             st.error("Não foi possível identificar itens no PDF. Verifique o layout/arquivo.")
         else:
             st.success(msg)
-            df_pdf = pd.DataFrame(movimentos)
-            col_order = ["sku_pdf", "sku", "quantidade", "mapeado", "produto", "variacao"]
-            df_pdf = df_pdf[[c for c in col_order if c in df_pdf.columns]]
+            # Colunas e tipos fixos: sem inferência de dtype sobre a lista de dicts
+            df_pdf = pd.DataFrame.from_records(movimentos, columns=PDF_PREVIEW_COLUMNS).astype(PDF_PREVIEW_DTYPES)
             
             # Coluna editável para correção (começa igual ao lido)
-            df_pdf["quantidade_corrigida"] = df_pdf["quantidade"].astype(int)
+            df_pdf["quantidade_corrigida"] = df_pdf["quantidade"].to_numpy(dtype=np.int32)
             
             st.write("Prévia (ajuste a coluna **Qtd. corrigida** se algum valor veio errado do PDF):")
             edited = st.data_editor(
@@ -922,21 +1526,16 @@ elif page == "Baixa por PDF":
             st.markdown("### Conferência: Itens do PDF vs Estoque Atual")
             
             # Mapas auxiliares
-            sku_san_to_orig = sanitized_to_original_sku_map()
-            existentes = set(sku_san_to_orig.keys())
-            df_estoque_atual = stock_df()
-            map_estoque = {str(row["sku"]): int(row["estoque"]) for _, row in df_estoque_atual.iterrows()}
+            sku_san_to_orig, estoque_series, existentes = _baixa_maps(_db_version())
             
             preview = edited.copy()
-
-            def to_original_if_possible(sku_val: str) -> str:
-                s = str(sku_val or "")
-                s_san = sanitize_sku(s)
-                return sku_san_to_orig.get(s_san, s)
             
             # Criar as colunas do preview na ordem correta
             preview["SKU (PDF)"] = preview.get("sku_pdf", "")
-            preview["SKU (no estoque)"] = preview.get("sku", "").map(to_original_if_possible)
+            # SKU digitado -> SKU original do cadastro (mesma limpeza de sanitize_sku, em colunas)
+            sku_txt = preview["sku"].fillna("").astype(str)
+            sku_san = _sanitize_sku_series(sku_txt)
+            preview["SKU (no estoque)"] = sku_san.map(sku_san_to_orig).fillna(sku_txt)
             preview["Qtd. (PDF)"] = preview.get("quantidade", 0).astype(int)
             
             # usar sempre a corrigida (fallback para lida)
@@ -946,7 +1545,7 @@ elif page == "Baixa por PDF":
             preview["Qtd. (usada)"] = pd.to_numeric(qtd_usada, errors="coerce").fillna(0).astype(int).clip(lower=0)
             
             preview["Estoque atual (antes)"] = (
-                preview["SKU (no estoque)"].map(lambda s: map_estoque.get(str(s), 0)).fillna(0).astype(int)
+                preview["SKU (no estoque)"].astype(str).map(estoque_series).fillna(0).astype(int)
             )
             
             # REMOVIDO: preview["Estoque após (simulado)"] = preview["Estoque atual (antes)"] - preview["Qtd. (usada)"]
@@ -958,19 +1557,11 @@ elif page == "Baixa por PDF":
             preview["Será vendido"] = preview["Qtd. (usada)"] - preview["Faltará"]
             
             # Status textual baseado no que faltará
-            def status_row(row):
-                faltara = row["Faltará"]
-                sera_vendido = row["Será vendido"]
-                estoque_atual = row["Estoque atual (antes)"]
-                
-                if faltara > 0:
-                    return f"FALTARÁ VENDER {faltara}"
-                elif sera_vendido == estoque_atual:
-                    return "ZERA ESTOQUE"
-                else:
-                    return "OK"
-            
-            preview["Status"] = preview.apply(status_row, axis=1)
+            preview["Status"] = np.select(
+                [preview["Faltará"] > 0, preview["Será vendido"] == preview["Estoque atual (antes)"]],
+                ["FALTARÁ VENDER " + preview["Faltará"].astype(str), "ZERA ESTOQUE"],
+                default="OK",
+            )
             
             # Flag de quantidades muito altas com base na Qtd. (usada)
             preview["Qtd muito alta?"] = preview["Qtd. (usada)"] > HIGH_QTY_THRESHOLD
@@ -982,38 +1573,30 @@ elif page == "Baixa por PDF":
             preview = preview[cols_preview]
             
             # Destaques visuais
-            def hl_simulado(row):
-                styles = [""] * len(row)
-                try:
-                    faltara = row.get("Faltará", 0)
-                    sera_vendido = row.get("Será vendido", 0)
-                    estoque_atual = row.get("Estoque atual (antes)", 0)
-                    qtd_alta = row.get("Qtd muito alta?", False)
-                    
-                    # Se faltará vender algum item
-                    if faltara > 0:
-                        styles = ["background-color: #ff9966"] * len(row)  # laranja para itens que faltarão
-                    # Se zera o estoque
-                    elif sera_vendido == estoque_atual:
-                        styles = ["background-color: #fff2cc"] * len(row)  # amarelo para itens que zeram estoque
-                    # Quantidade muito alta
-                    if qtd_alta:
-                        styles = ["background-color: #ffe5b4"] * len(row)  # laranja claro
-                except:
-                    pass
-                return styles
+            def hl_simulado(frame):
+                # Qtd muito alta tem prioridade; depois falta (laranja) e zera estoque (amarelo)
+                return _row_styles(frame, np.select(
+                    [
+                        frame["Qtd muito alta?"].astype(bool),
+                        frame["Faltará"] > 0,
+                        frame["Será vendido"] == frame["Estoque atual (antes)"],
+                    ],
+                    ["background-color: #ffe5b4", "background-color: #ff9966", "background-color: #fff2cc"],
+                    default="",
+                ))
             
             show_only_critical = st.toggle("Mostrar apenas itens que faltarão/zeram estoque", value=False)
-            filtered_preview = preview.copy()
+            # Só leitura daqui em diante: o Styler e os filtros não precisam de cópias
+            filtered_preview = preview
             if show_only_critical:
-                mask_crit = (filtered_preview["Faltará"] > 0) | (filtered_preview["Será vendido"] == filtered_preview["Estoque atual (antes)"])
-                filtered_preview = filtered_preview[mask_crit]
+                mask_crit = (preview["Faltará"] > 0) | (preview["Será vendido"] == preview["Estoque atual (antes)"])
+                filtered_preview = preview.loc[mask_crit]
                 st.caption(f"Exibindo {len(filtered_preview)} de {len(preview)} itens (apenas críticos).")
             
-            st.dataframe(filtered_preview.style.apply(hl_simulado, axis=1), use_container_width=True)
+            st.dataframe(filtered_preview.style.apply(hl_simulado, axis=None), use_container_width=True)
             
             # Bloco de conferência de quantidades altas
-            df_high = preview[preview["Qtd muito alta?"]].copy()
+            df_high = preview.loc[preview["Qtd muito alta?"]]
             confirm_high_needed = not df_high.empty
             confirm_high = False
             
@@ -1058,65 +1641,51 @@ elif page == "Baixa por PDF":
                     st.error("Há linhas com 'Qtd. corrigida' inválida (<= 0). Corrija antes de aplicar.")
                     st.stop()
                 
-                backup_database()
-                con = get_conn()
-                cur = con.cursor()
+                # Snapshot do estado anterior às baixas; a cópia segue em segundo plano
+                backup_database_async(force=True)
                 ok_count = 0
                 mapeados = 0
-                erros = 0
-                faltando = 0
-                total_faltou_vender = 0
+                mapeamentos: List[Tuple[str, str]] = []
                 
-                for _, r in edited.iterrows():
-                    sku_pdf = sanitize_sku(str(r.get("sku_pdf", "")))
-                    
-                    # CORREÇÃO: Pegar quantidade corretamente
-                    qtd_corrigida = r.get("quantidade_corrigida")
-                    if pd.isna(qtd_corrigida) or qtd_corrigida is None:
-                        qtd = int(r.get("quantidade", 0) or 0)
-                    else:
-                        qtd = int(qtd_corrigida)
-                    
-                    sku_user = str(r.get("sku", ""))
-                    sku_est_sanit = sanitize_sku(sku_user)
-                    
-                    if not sku_est_sanit:
-                        faltando += 1
-                        continue
-                    
-                    if sku_est_sanit not in existentes:
-                        erros += 1
-                        continue
-                    
-                    sku_original = sku_san_to_orig[sku_est_sanit]
-                    
-                    # NOVA LÓGICA: Verificar estoque atual e ajustar quantidade se necessário
-                    estoque_atual_item = map_estoque.get(sku_original, 0)
-                    quantidade_a_baixar = min(qtd, estoque_atual_item)  # Baixa no máximo o estoque disponível
-                    faltara_item = max(0, qtd - estoque_atual_item)
-                    
-                    try:
-                        if quantidade_a_baixar > 0:  # Só registra se houver algo para baixar
-                            record_movement(sku_original, -quantidade_a_baixar, "venda_pdf")
-                            ok_count += 1
-                            
-                            if faltara_item > 0:
-                                total_faltou_vender += faltara_item
-                                st.warning(f"SKU {sku_original}: Baixadas {quantidade_a_baixar} unidades (faltou baixar {faltara_item})")
-                        
-                        if grava_map and sku_pdf:
-                            try:
-                                cur.execute(
-                                    "INSERT INTO sku_mapping(sku_pdf, sku_estoque) VALUES(?, ?) "
-                                    "ON CONFLICT(sku_pdf) DO UPDATE SET sku_estoque=excluded.sku_estoque",
-                                    (sku_pdf, sku_original)
-                                )
-                                con.commit()
-                                mapeados += 1
-                            except Exception:
-                                pass
-                    except Exception:
-                        erros += 1
+                # Limpeza e conferência em colunas (mesmas regras de sanitize_sku)
+                sku_pdf_col = _sanitize_sku_series(edited["sku_pdf"])
+                sku_est_col = _sanitize_sku_series(edited["sku"])
+                # CORREÇÃO: usa a quantidade corrigida; sem ela, a lida do PDF
+                qtd_col = pd.to_numeric(edited["quantidade_corrigida"], errors="coerce").fillna(
+                    pd.to_numeric(edited["quantidade"], errors="coerce")
+                ).fillna(0)
+                
+                vazio = sku_est_col.eq("")
+                conhecido = sku_est_col.isin(existentes)
+                faltando = int(vazio.sum())
+                erros = int((~vazio & ~conhecido).sum())
+                
+                sku_orig_col = sku_est_col[conhecido].map(sku_san_to_orig)
+                sku_arr = sku_orig_col.to_numpy(dtype=object)
+                qty_arr = qtd_col[conhecido].to_numpy(dtype=np.int64)
+                est_arr = sku_orig_col.map(estoque_series).fillna(0).to_numpy(dtype=np.int64)
+                
+                # NOVA LÓGICA: baixa no máximo o estoque disponível; o resto "faltará"
+                to_baixar = np.minimum(qty_arr, est_arr)
+                faltara = np.maximum(0, qty_arr - est_arr)
+                com_baixa = to_baixar > 0  # Só registra se houver algo para baixar
+                
+                baixas = [(sku, -int(q), "venda_pdf") for sku, q in zip(sku_arr[com_baixa], to_baixar[com_baixa])]
+                parcial = com_baixa & (faltara > 0)
+                total_faltou_vender = int(faltara[parcial].sum())
+                for sku, q, f in zip(sku_arr[parcial], to_baixar[parcial], faltara[parcial]):
+                    st.warning(f"SKU {sku}: Baixadas {q} unidades (faltou baixar {f})")
+                
+                if grava_map:
+                    pdf_arr = sku_pdf_col[conhecido].to_numpy(dtype=object)
+                    mapeamentos = [(sp, sku) for sp, sku in zip(pdf_arr, sku_arr) if sp]
+                
+                # Baixas + mapeamentos em uma única transação (um commit/fsync por PDF)
+                try:
+                    ok_count, mapeados = apply_pdf_baixas(baixas, mapeamentos)
+                except Exception as e:
+                    erros += len(baixas)
+                    st.error(f"Erro ao registrar baixas: {e}")
                 
                 mensagem_sucesso = f"Baixas aplicadas! OK: {ok_count} | Mapeamentos salvos: {mapeados} | Sem SKU preenchido: {faltando} | Erros: {erros}"
                 if total_faltou_vender > 0:
@@ -1128,13 +1697,14 @@ elif page == "Baixa por PDF":
             # Exporta exatamente o que está na grade (inclui quantidade_corrigida)
             st.download_button(
                 "📥 Exportar leitura do PDF (CSV)",
-                edited.to_csv(index=False).encode("utf-8"),
+                cached_csv_bytes(edited),
                 "baixa_pdf_preview.csv",
                 "text/csv"
             )
 
 # -------- Estoque Atual --------
-elif page == "Estoque Atual":
+@_fragment
+def _page_estoque_atual() -> None:
     st.subheader("Estoque atual por SKU")
     f1, f2, f3 = st.columns([2,1,1])
     with f1:
@@ -1169,26 +1739,22 @@ elif page == "Estoque Atual":
     if df.empty:
         st.info("Nenhuma variante encontrada.")
     else:
-        def highlight(row):
-            if row["estoque"] < 0:
-                return ["background-color: #ffcccc" for _ in row]
-            if row["estoque"] <= critico:
-                return ["background-color: #fff2cc" for _ in row]
-            return ["" for _ in row]
+        def highlight(frame):
+            return _row_styles(frame, np.select(
+                [frame["estoque"] < 0, frame["estoque"] <= critico],
+                ["background-color: #ffcccc", "background-color: #fff2cc"],
+                default="",
+            ))
         
-        display_df = df.copy()
-        if 'custo_unitario' in display_df.columns:
-            display_df['custo_unitario'] = display_df['custo_unitario'].apply(lambda x: f"R$ {x:,.2f}" if pd.notnull(x) else "R$ 0,00")
-        if 'valor_estoque' in display_df.columns:
-            # Para itens negativos, mostrar valor zero
-            display_df['valor_estoque'] = display_df.apply(
-                lambda x: "R$ 0,00" if x['estoque'] < 0 else f"R$ {x['valor_estoque']:,.2f}", 
-                axis=1
+        # Colunas seguem numéricas; o "R$" é só formatação do Styler (itens negativos mostram valor zero)
+        display_df_reset = df.reset_index(drop=True)
+        if 'valor_estoque' in display_df_reset.columns:
+            display_df_reset = display_df_reset.assign(
+                valor_estoque=display_df_reset["valor_estoque"].where(display_df_reset["estoque"] >= 0)
             )
-        
-        # CORREÇÃO: Resetar índice para evitar erro de índice duplicado
-        display_df_reset = display_df.reset_index(drop=True)
-        st.dataframe(display_df_reset.style.apply(highlight, axis=1), use_container_width=True, hide_index=True)
+        moeda = [c for c in ("custo_unitario", "valor_estoque") if c in display_df_reset.columns]
+        styled = display_df_reset.style.apply(highlight, axis=None).format("R$ {:,.2f}", subset=moeda, na_rep="R$ 0,00")
+        st.dataframe(styled, use_container_width=True, hide_index=True)
         
         total_criticos = len(df[df["estoque"] <= critico])
         total_negativos = len(df[df["estoque"] < 0])
@@ -1200,11 +1766,12 @@ elif page == "Estoque Atual":
             st.metric("Estoques negativos", total_negativos)
 
 # -------- Histórico --------
-elif page == "Histórico":
+@_fragment
+def _page_historico() -> None:
     st.subheader("Histórico de Movimentações")
     colf1, colf2, colf3 = st.columns([2,1,1])
     with colf1:
-        sku_escolhido = st.selectbox("Filtrar por SKU (digite para filtrar)", [""] + list(list_variants_df()["sku"].tolist()), index=0)
+        sku_escolhido = st.selectbox("Filtrar por SKU (digite para filtrar)", [""] + list_variant_skus(), index=0)
     with colf2:
         motivo = st.selectbox("Motivo", ["Todos", "entrada", "venda", "venda_pdf", "ajuste"])
     with colf3:
@@ -1215,51 +1782,56 @@ elif page == "Histórico":
     st.dataframe(dfh, use_container_width=True)
 
 # -------- Exportar CSV --------
-elif page == "Exportar CSV":
+@_fragment
+def _page_exportar_csv() -> None:
     st.subheader("Exportar dados")
-    v = list_variants_df()
-    s = stock_df()
-    m = movements_df()
+    # Os CSVs só são gerados depois que o usuário pede (nada é montado só por abrir a página)
+    if not st.checkbox("Preparar arquivos CSV", key="preparar_csv"):
+        st.caption("Marque para gerar os arquivos de exportação.")
+        return
+    version = _db_version()
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.download_button("📥 Variantes (CSV)", v.to_csv(index=False).encode("utf-8"), "variantes.csv", "text/csv")
+        st.download_button("📥 Variantes (CSV)", export_csv(version, "variantes"), "variantes.csv", "text/csv")
     with col2:
-        st.download_button("📥 Estoque (CSV)", s.to_csv(index=False).encode("utf-8"), "estoque.csv", "text/csv")
+        st.download_button("📥 Estoque (CSV)", export_csv(version, "estoque"), "estoque.csv", "text/csv")
     with col3:
-        st.download_button("📥 Movimentações (CSV)", m.to_csv(index=False).encode("utf-8"), "movimentacoes.csv", "text/csv")
+        st.download_button("📥 Movimentações (CSV)", export_csv(version, "movimentacoes"), "movimentacoes.csv", "text/csv")
 
 # -------- Editar Variante --------
-elif page == "Editar Variante":
+@_fragment
+def _page_editar_variante() -> None:
     st.subheader("Editar Variante (com autocomplete de SKU)")
-    vdf = list_variants_df()
-    current_sku = st.selectbox("Selecione o SKU", vdf["sku"].tolist(), index=None, placeholder="Digite parte do SKU…")
+    current_sku = st.selectbox("Selecione o SKU", list_variant_skus(), index=None, placeholder="Digite parte do SKU…")
     
     if current_sku:
         det = get_variant_details(current_sku)
-        col1, col2, col3, col4, col5 = st.columns(5)
-        with col1:
-            category = st.text_input("Categoria", det["category"])
-        with col2:
-            subtype = st.text_input("Subtipo", det["subtype"])
-        with col3:
-            color = st.text_input("Cor", det["color"])
-        with col4:
-            size = st.text_input("Tamanho", det["size"])
-        with col5:
-            sku_base = st.text_input("SKU Base", det["sku_base"] or "")
-        
-        # Custos
-        c1, c2 = st.columns(2)
-        with c1:
-            custo_unitario_produto = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=float(det.get("custo_unitario_produto", 0) or 0), step=0.01, help="Custo padrão do tipo/subtipo. Variantes podem ter custo próprio.")
-        with c2:
-            cur_val = det.get("custo_unitario_variante", None)
-            custo_unitario_variante = st.number_input("Custo Unitário (VARIANTE) R$ (opcional)", min_value=0.0, value=float(cur_val if cur_val is not None else 0.0), step=0.01, help="Se > 0, substitui o custo do produto apenas para esta variante.")
-        
-        new_sku = st.text_input("Novo SKU", det["sku"])
+        with st.form("editar_variante"):
+            col1, col2, col3, col4, col5 = st.columns(5)
+            with col1:
+                category = st.text_input("Categoria", det["category"])
+            with col2:
+                subtype = st.text_input("Subtipo", det["subtype"])
+            with col3:
+                color = st.text_input("Cor", det["color"])
+            with col4:
+                size = st.text_input("Tamanho", det["size"])
+            with col5:
+                sku_base = st.text_input("SKU Base", det["sku_base"] or "")
+            
+            # Custos
+            c1, c2 = st.columns(2)
+            with c1:
+                custo_unitario_produto = st.number_input("Custo Unitário (PRODUTO) R$", min_value=0.0, value=float(det.get("custo_unitario_produto", 0) or 0), step=0.01, help="Custo padrão do tipo/subtipo. Variantes podem ter custo próprio.")
+            with c2:
+                cur_val = det.get("custo_unitario_variante", None)
+                custo_unitario_variante = st.number_input("Custo Unitário (VARIANTE) R$ (opcional)", min_value=0.0, value=float(cur_val if cur_val is not None else 0.0), step=0.01, help="Se > 0, substitui o custo do produto apenas para esta variante.")
+            
+            new_sku = st.text_input("Novo SKU", det["sku"])
+            submitted = st.form_submit_button("Salvar alterações", type="primary")
         
-        if st.button("Salvar alterações", type="primary"):
+        if submitted:
             cvar = custo_unitario_variante if custo_unitario_variante > 0 else None
             ok, msg = update_variant(det["sku"], new_sku, category, subtype, color, size, sku_base if sku_base else None, custo_unitario_produto, cvar)
             if ok:
@@ -1268,10 +1840,10 @@ elif page == "Editar Variante":
                 st.error(msg)
 
 # -------- Remover Variante --------
-elif page == "Remover Variante":
+@_fragment
+def _page_remover_variante() -> None:
     st.subheader("Remover Variante")
-    vdf = list_variants_df()
-    sku = st.selectbox("Selecione o SKU", vdf["sku"].tolist(), index=None, placeholder="Digite para filtrar…")
+    sku = st.selectbox("Selecione o SKU", list_variant_skus(), index=None, placeholder="Digite para filtrar…")
     
     if st.button("Remover", type="primary"):
         if not sku:
@@ -1281,39 +1853,52 @@ elif page == "Remover Variante":
             st.success(msg) if ok else st.error(msg)
 
 # -------- Mapeamento de SKUs --------
-elif page == "Mapeamento de SKUs":
+MAPPING_PAGE_SIZE = 100
+MAPPING_SEARCH_LIMIT = 50
+
+@_fragment
+def _page_mapeamento() -> None:
     st.subheader("Mapeamentos (sku_pdf → sku)")
-    con = get_conn()
-    df_map = pd.read_sql_query("SELECT id, sku_pdf, sku_estoque FROM sku_mapping ORDER BY id DESC", con)
+    total_map = int(cached_query("SELECT COUNT(*) AS n FROM sku_mapping")["n"].iloc[0])
+    page_size = MAPPING_PAGE_SIZE
+    total_pages = max(1, -(-total_map // page_size))
+    page_no = st.number_input("Página", min_value=1, max_value=total_pages, value=1, step=1)
+    df_map = cached_query(
+        "SELECT id, sku_pdf, sku_estoque FROM sku_mapping ORDER BY id DESC LIMIT ? OFFSET ?",
+        (page_size, (int(page_no) - 1) * page_size),
+    )
     st.dataframe(df_map, use_container_width=True)
+    st.caption(f"{total_map} mapeamentos · página {int(page_no)} de {total_pages}")
     
     # NOVO: Excluir mapeamento
     st.markdown("### Excluir mapeamento existente")
-    if not df_map.empty:
+    if total_map:
         col_del1, col_del2, col_del3 = st.columns([2,2,1])
         with col_del1:
             del_by = st.radio("Selecionar por", ["ID", "SKU (PDF)"], horizontal=True)
         with col_del2:
             if del_by == "ID":
-                sel_id = st.selectbox("ID do mapeamento", df_map["id"].tolist(), index=None, placeholder="Selecione o ID…")
+                sel_id = st.selectbox("ID do mapeamento", df_map["id"].tolist(), index=None, placeholder="Selecione o ID da página…")
                 sel_sku_pdf = None
             else:
-                sel_sku_pdf = st.selectbox("SKU (PDF)", df_map["sku_pdf"].tolist(), index=None, placeholder="Selecione o SKU (PDF)…")
+                busca_pdf = st.text_input("Buscar SKU (PDF)", placeholder="Digite parte do SKU…")
+                opcoes_pdf = cached_query(
+                    "SELECT sku_pdf FROM sku_mapping WHERE sku_pdf LIKE ? ORDER BY sku_pdf LIMIT ?",
+                    (f"%{busca_pdf.strip()}%", MAPPING_SEARCH_LIMIT),
+                )["sku_pdf"].tolist()
+                sel_sku_pdf = st.selectbox("SKU (PDF)", opcoes_pdf, index=None, placeholder="Selecione o SKU (PDF)…")
                 sel_id = None
         with col_del3:
             do_delete = st.button("🗑️ Excluir", type="secondary")
         
         if do_delete:
             try:
-                con = get_conn()
                 if del_by == "ID" and sel_id is not None:
-                    con.execute("DELETE FROM sku_mapping WHERE id=?", (int(sel_id),))
-                    con.commit()
+                    delete_sku_mapping(id=int(sel_id))
                     st.success(f"Mapeamento ID {sel_id} excluído.")
                     st.rerun()
                 elif del_by != "ID" and sel_sku_pdf:
-                    con.execute("DELETE FROM sku_mapping WHERE sku_pdf=?", (str(sel_sku_pdf),))
-                    con.commit()
+                    delete_sku_mapping(sku_pdf=str(sel_sku_pdf))
                     st.success(f"Mapeamento do SKU (PDF) '{sel_sku_pdf}' excluído.")
                     st.rerun()
                 else:
@@ -1328,17 +1913,12 @@ elif page == "Mapeamento de SKUs":
         with col1:
             sku_pdf = st.text_input("SKU (PDF)")
         with col2:
-            sku_estoque = st.selectbox("SKU no estoque", list_variants_df()["sku"].tolist(), index=None, placeholder="Digite para filtrar…")
+            sku_estoque = st.selectbox("SKU no estoque", list_variant_skus(), index=None, placeholder="Digite para filtrar…")
         
         if st.button("Adicionar mapeamento"):
             if sku_pdf and sku_estoque:
                 try:
-                    con.execute(
-                        "INSERT INTO sku_mapping(sku_pdf, sku_estoque) VALUES(?, ?) "
-                        "ON CONFLICT(sku_pdf) DO UPDATE SET sku_estoque=excluded.sku_estoque",
-                        (sanitize_sku(sku_pdf), str(sku_estoque))
-                    )
-                    con.commit()
+                    upsert_sku_mappings([(sanitize_sku(sku_pdf), str(sku_estoque))])
                     st.success("Mapeamento adicionado/atualizado.")
                     st.rerun()
                 except Exception as e:
@@ -1347,17 +1927,20 @@ elif page == "Mapeamento de SKUs":
                 st.error("Preencha os dois campos.")
 
 # -------- Gerenciar SKU Base --------
-elif page == "Gerenciar SKU Base":
+@_fragment
+def _page_sku_base() -> None:
     st.subheader("Atualizar SKU Base e regenerar SKUs das variantes")
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        category = st.text_input("Categoria")
-    with col2:
-        subtype = st.text_input("Subtipo")
-    with col3:
-        new_base = st.text_input("Novo SKU Base (ex.: MOL-CARECA)")
+    with st.form("sku_base"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            category = st.text_input("Categoria")
+        with col2:
+            subtype = st.text_input("Subtipo")
+        with col3:
+            new_base = st.text_input("Novo SKU Base (ex.: MOL-CARECA)")
+        submitted = st.form_submit_button("Atualizar SKU Base", type="primary")
     
-    if st.button("Atualizar SKU Base", type="primary"):
+    if submitted:
         if not (category and subtype and new_base):
             st.error("Preencha categoria, subtipo e novo SKU base.")
         else:
@@ -1365,7 +1948,8 @@ elif page == "Gerenciar SKU Base":
             st.success(msg) if ok else st.error(msg)
 
 # -------- Custo por Categoria/Subtipo (em massa) --------
-elif page == "Custo por Categoria/Subtipo (em massa)":
+@_fragment
+def _page_custo_em_massa() -> None:
     st.subheader("Atualizar Custo Unitário em Massa por Categoria/Subtipo")
     df_produtos = list_products_df()
     
@@ -1404,9 +1988,7 @@ elif page == "Custo por Categoria/Subtipo (em massa)":
             df_alvo = df_produtos[df_produtos["category"] == categoria_escolhida]
             if subtipos_escolhidos:
                 df_alvo = df_alvo[df_alvo["subtype"].isin(subtipos_escolhidos)]
-            vdf = list_variants_df()
-            prod_ids = df_alvo["id"].tolist()
-            afetadas = len(vdf[vdf["product_id"].isin(prod_ids)]) if "product_id" in vdf.columns else 0
+            afetadas = count_variants_for_products(df_alvo["id"].tolist())
             st.caption(f"Variantes impactadas (estimativa): **{afetadas}** (apenas no custo padrão; variantes com custo próprio continuam com o seu valor)")
         
         colb1, colb2 = st.columns([1, 2])
@@ -1426,28 +2008,20 @@ elif page == "Custo por Categoria/Subtipo (em massa)":
                 if alvo.empty:
                     st.warning("Não há produtos para atualizar com os filtros escolhidos.")
                 else:
-                    ok_cnt, err_cnt = 0, 0
-                    for _, row in alvo.iterrows():
-                        ok, msg = update_custo_unitario(row["category"], row["subtype"], float(novo_custo))
-                        if ok:
-                            ok_cnt += 1
-                        else:
-                            err_cnt += 1
-                            st.warning(f"{row['category']} / {row['subtype']}: {msg}")
-                    
-                    st.success(f"Custo padrão atualizado para R$ {novo_custo:.2f} em {ok_cnt} produto(s).")
-                    if err_cnt:
-                        st.error(f"Ocorreu erro em {err_cnt} produto(s).")
+                    try:
+                        ok_cnt = bulk_update_custo(categoria_escolhida, alvo["subtype"].tolist(), float(novo_custo))
+                        st.success(f"Custo padrão atualizado para R$ {novo_custo:.2f} em {ok_cnt} produto(s).")
+                    except sqlite3.Error as e:
+                        st.error(f"Erro ao atualizar custo unitário: {e}")
 
 # -------- Contagem de Estoque --------
-elif page == "Contagem de Estoque":
+@_fragment
+def _page_contagem() -> None:
     st.subheader("Contagem de Estoque (ajuste por inventário)")
-    vdf = list_variants_df()
-    sku = st.selectbox("SKU", vdf["sku"].tolist(), index=None, placeholder="Digite para filtrar…")
+    sku = st.selectbox("SKU", list_variant_skus(), index=None, placeholder="Digite para filtrar…")
     
     if sku:
-        atual = stock_df(filter_text=sku)
-        saldo_atual = int(atual.loc[atual["sku"] == sku, "estoque"].values[0]) if not atual.empty else 0
+        saldo_atual = stock_for_sku(sku)
         novo = st.number_input("Quantidade contada (substitui o saldo)", value=saldo_atual, step=1)
         
         if st.button("Aplicar contagem", type="primary"):
@@ -1457,37 +2031,44 @@ elif page == "Contagem de Estoque":
                 st.success(f"Saldo ajustado. Anterior: {saldo_atual} | Novo: {novo}")
 
 # -------- Valor do Estoque (CORRIGIDO) --------
-elif page == "Valor do Estoque":
+@_fragment
+def _page_valor_estoque() -> None:
     st.subheader("💰 Valor Total do Estoque (Apenas Itens Positivos)")
     
-    # Adicionar toggle para escolher entre visualização
-    col1, col2, col3 = st.columns([2, 2, 2])
-    with col1:
-        filtro_categoria = st.text_input("Filtrar por categoria", placeholder="Ex: moletom, camiseta")
-    with col2:
-        filtro_subtipo = st.text_input("Filtrar por subtipo", placeholder="Ex: canguru, careca")
-    with col3:
-        mostrar_negativos = st.checkbox("Mostrar itens negativos", value=False, 
-                                       help="Mostra itens com estoque negativo (não afetam o valor total)")
-    
-    # Obter dados (apenas positivos para cálculos)
-    df_positivo = stock_value_positive_df()
-    
-    # Aplicar filtros
-    if filtro_categoria:
-        df_positivo = df_positivo[df_positivo['category'].str.contains(filtro_categoria, case=False, na=False)]
-    if filtro_subtipo:
-        df_positivo = df_positivo[df_positivo['subtype'].str.contains(filtro_subtipo, case=False, na=False)]
+    # Filtros num formulário: a página só recalcula ao clicar em "Aplicar";
+    # os valores aplicados ficam em session_state e sobrevivem à troca de página
+    filtros = st.session_state.setdefault("filtros", {"categoria": "", "subtipo": "", "negativos": False})
+    for key, campo in (("valor_cat", "categoria"), ("valor_sub", "subtipo"), ("valor_neg", "negativos")):
+        if key not in st.session_state:
+            st.session_state[key] = filtros[campo]
+    with st.form("filtros_valor"):
+        col1, col2, col3 = st.columns([2, 2, 2])
+        with col1:
+            st.text_input("Filtrar por categoria", key="valor_cat", placeholder="Ex: moletom, camiseta")
+        with col2:
+            st.text_input("Filtrar por subtipo", key="valor_sub", placeholder="Ex: canguru, careca")
+        with col3:
+            st.checkbox("Mostrar itens negativos", key="valor_neg",
+                        help="Mostra itens com estoque negativo (não afetam o valor total)")
+        submitted = st.form_submit_button("Aplicar")
+    if submitted:
+        filtros = {
+            "categoria": st.session_state["valor_cat"],
+            "subtipo": st.session_state["valor_sub"],
+            "negativos": st.session_state["valor_neg"],
+        }
+        st.session_state["filtros"] = filtros
+    filtro_categoria = filtros["categoria"]
+    filtro_subtipo = filtros["subtipo"]
+    mostrar_negativos = filtros["negativos"]
     
-    # Obter dados completos se necessário para mostrar negativos
+    # Dados já filtrados no SQL: com negativos, uma só consulta completa fornece as duas fatias
     if mostrar_negativos:
-        df_completo = stock_value_df()
-        if filtro_categoria:
-            df_completo = df_completo[df_completo['category'].str.contains(filtro_categoria, case=False, na=False)]
-        if filtro_subtipo:
-            df_completo = df_completo[df_completo['subtype'].str.contains(filtro_subtipo, case=False, na=False)]
+        df_completo = stock_value_df(categoria=filtro_categoria, subtipo=filtro_subtipo)
+        df_positivo = df_completo[df_completo['estoque'] > 0]
         df_negativo = df_completo[df_completo['estoque'] < 0]
     else:
+        df_positivo = stock_value_positive_df(categoria=filtro_categoria, subtipo=filtro_subtipo)
         df_negativo = pd.DataFrame()
     
     if df_positivo.empty and (not mostrar_negativos or df_negativo.empty):
@@ -1527,52 +2108,47 @@ elif page == "Valor do Estoque":
         
         st.divider()
         st.subheader("Valor por Categoria/Subtipo (Apenas Positivos)")
-        df_agrupado = df_positivo.groupby(['category', 'subtype']).agg({
-            'estoque': 'sum',
-            'valor_estoque': 'sum',
-            'sku': 'count'
-        }).reset_index().rename(columns={'sku':'quantidade_skus','estoque':'total_unidades'}).sort_values('valor_estoque', ascending=False)
+        df_agrupado = stock_value_by_category(filtro_categoria, filtro_subtipo)
         
-        disp = df_agrupado.copy()
-        disp['valor_estoque'] = disp['valor_estoque'].apply(lambda x: f"R$ {x:,.2f}")
-        st.dataframe(disp, use_container_width=True)
+        st.dataframe(df_agrupado.style.format({"valor_estoque": "R$ {:,.2f}"}), use_container_width=True)
         
         st.divider()
         st.subheader("Detalhamento Completo do Estoque")
         
-        # Preparar dados para exibição
+        # Preparar dados para exibição: positivos + negativos = linhas não zeradas da consulta completa,
+        # que já vem ordenada por categoria/subtipo/cor/tamanho no SQL (sem concat nem novo sort)
         if mostrar_negativos:
-            df_exibicao = pd.concat([df_positivo, df_negativo]).sort_values(['category', 'subtype', 'color', 'size'])
+            df_exibicao = df_completo[df_completo['estoque'] != 0]
         else:
             df_exibicao = df_positivo
         
-        # Função para destacar itens negativos
-        def highlight_negative(row):
-            if row['estoque'] < 0:
-                return ['background-color: #ffcccc'] * len(row)
-            return [''] * len(row)
-        
-        detalhado = df_exibicao.copy()
-        detalhado['custo_unitario'] = detalhado['custo_unitario'].apply(lambda x: f"R$ {x:,.2f}" if pd.notnull(x) else "R$ 0,00")
-        # Para itens negativos, mostrar valor zero
-        detalhado['valor_estoque'] = detalhado.apply(
-            lambda x: "R$ 0,00" if x['estoque'] < 0 else f"R$ {x['valor_estoque']:,.2f}", 
-            axis=1
-        )
-        
-        # CORREÇÃO: Resetar o índice para evitar o erro de índice duplicado
-        detalhado_reset = detalhado.reset_index(drop=True)
-        
-        # Aplicar o estilo no DataFrame com índice resetado
-        styled_df = detalhado_reset.style.apply(highlight_negative, axis=1)
-        st.dataframe(styled_df, use_container_width=True)
+        # Formatação e estilo da tabela longa só quando o usuário pede para vê-la
+        if st.checkbox("Mostrar detalhamento completo", value=False, key="valor_detalhado"):
+            # CORREÇÃO: Resetar o índice para evitar o erro de índice duplicado
+            detalhado_reset = df_exibicao.reset_index(drop=True)
+            # Para itens negativos, mostrar valor zero (NaN cai no na_rep do Styler; colunas seguem numéricas)
+            detalhado_reset = detalhado_reset.assign(
+                valor_estoque=detalhado_reset['valor_estoque'].where(detalhado_reset['estoque'] >= 0)
+            )
+            
+            # Destacar itens negativos: máscara calculada uma vez, estilo aplicado à tabela inteira
+            neg_css = np.where(detalhado_reset['estoque'].to_numpy() < 0, 'background-color: #ffcccc', '')
+            styled_df = (
+                detalhado_reset.style
+                .apply(lambda frame: _row_styles(frame, neg_css), axis=None)
+                .format("R$ {:,.2f}", subset=['custo_unitario', 'valor_estoque'], na_rep="R$ 0,00")
+            )
+            st.dataframe(styled_df, use_container_width=True)
         
         # Exportar dados
-        csv = df_exibicao.to_csv(index=False).encode('utf-8')
+        csv = cached_csv_bytes(df_exibicao)
         st.download_button("📥 Exportar Dados de Valor do Estoque (CSV)", csv, "valor_estoque.csv", "text/csv")
 
 # -------- Gráfico de Vendas --------
-elif page == "Gráfico de Vendas":
+@_fragment
+def _page_vendas() -> None:
+    import plotly.express as px  # só esta página usa gráficos
+    
     st.subheader("📊 Gráfico de Vendas")
     coltop1, coltop2, coltop3 = st.columns(3)
     with coltop1:
@@ -1600,15 +2176,11 @@ elif page == "Gráfico de Vendas":
         with f2:
             filtro_sub = st.text_input("Subtipo (ex.: CARECA, CANGURU)", value="")
         
-        df_prod = df_vendas.copy()
-        if filtro_cat:
-            df_prod = df_prod[df_prod["category"].str.contains(filtro_cat, case=False, na=False)]
-        if filtro_sub:
-            df_prod = df_prod[df_prod["subtype"].str.contains(filtro_sub, case=False, na=False)]
+        df_prod = get_sales_data(dias, filtro_cat, filtro_sub) if (filtro_cat or filtro_sub) else df_vendas
         
-        total_qtd = int(df_prod["quantidade_vendida"].sum())
-        total_val = float(df_prod["valor_total_vendido"].sum())
-        total_regs = int(df_prod["numero_vendas"].sum())
+        # Os três totais numa só redução colunar
+        somas = df_prod[["quantidade_vendida", "valor_total_vendido", "numero_vendas"]].to_numpy().sum(axis=0)
+        total_qtd, total_val, total_regs = int(somas[0]), float(somas[1]), int(somas[2])
         
         m1, m2, m3 = st.columns(3)
         with m1:
@@ -1618,47 +2190,35 @@ elif page == "Gráfico de Vendas":
         with m3:
             st.metric("Registros (linhas) de venda", total_regs)
         
+        # Os três rankings saem de um único cálculo em cache (mesmo período e filtros)
+        df_top_todos, df_tam, df_itens = sales_rollups(dias, filtro_cat, filtro_sub)
+        
         st.divider()
         st.markdown("### Top Produtos (Categoria-Subtipo)")
-        df_top = (
-            df_prod.groupby(["category", "subtype"], as_index=False)[["quantidade_vendida", "valor_total_vendido"]]
-            .sum()
-            .assign(produto=lambda d: d["category"] + " - " + d["subtype"])
-            .sort_values("quantidade_vendida", ascending=False)
-            .head(limite_produtos)
-        )
+        df_top = df_top_todos.head(limite_produtos)
         
         if not df_top.empty:
-            fig1 = px.bar(
-                df_top,
-                x="quantidade_vendida",
-                y="produto",
-                orientation="h",
-                title=f"Top {limite_produtos} por Quantidade",
-                labels={"quantidade_vendida":"Quantidade","produto":"Produto"}
-            )
-            fig1.update_layout(yaxis={'categoryorder':'total ascending'})
-            st.plotly_chart(fig1, use_container_width=True)
-            
             if modo_valor == "Valor ao Custo":
-                fig2 = px.bar(
-                    df_top.sort_values("valor_total_vendido"),
-                    x="valor_total_vendido",
+                # Quantidade e valor numa figura só (subplots), em vez de dois gráficos serializados
+                fig_top = _hbar_pair(df_top, "produto", [
+                    ("quantidade_vendida", f"Top {limite_produtos} por Quantidade", "Quantidade"),
+                    ("valor_total_vendido", f"Top {limite_produtos} por Valor (Custo)", "Valor (R$)"),
+                ])
+            else:
+                fig_top = px.bar(
+                    df_top,
+                    x="quantidade_vendida",
                     y="produto",
                     orientation="h",
-                    title=f"Top {limite_produtos} por Valor (Custo)",
-                    labels={"valor_total_vendido":"Valor (R$)","produto":"Produto"}
+                    title=f"Top {limite_produtos} por Quantidade",
+                    labels={"quantidade_vendida":"Quantidade","produto":"Produto"}
                 )
-                fig2.update_layout(yaxis={'categoryorder':'total ascending'})
-                st.plotly_chart(fig2, use_container_width=True)
+                fig_top.update_layout(yaxis={'categoryorder':'total ascending'})
+            st.plotly_chart(fig_top, use_container_width=True)
         
         st.divider()
         st.markdown("### Tamanhos mais vendidos (no produto filtrado)")
         if not df_prod.empty:
-            df_tam = (
-                df_prod.groupby("size", as_index=False)[["quantidade_vendida","valor_total_vendido"]]
-                .sum().sort_values("quantidade_vendida", ascending=False).head(30)
-            )
             fig_tam = px.bar(
                 df_tam,
                 x="size",
@@ -1672,53 +2232,19 @@ elif page == "Gráfico de Vendas":
         
         st.divider()
         st.markdown("### Top Itens (Categoria-Subtipo-Cor-Tamanho)")
-        df_itens = (
-            df_prod
-            .assign(
-                item=lambda d: (
-                    d["category"].astype(str).str.upper().str.replace(r"\s+","-", regex=True) + "-" +
-                    d["subtype"].astype(str).str.upper().str.replace(r"\s+","-", regex=True) + "-" +
-                    d["color"].astype(str).str.upper().str.replace(r"\s+","-", regex=True) + "-" +
-                    d["size"].astype(str).str.upper()
-                )
-            )
-            .groupby("item", as_index=False)[["quantidade_vendida","valor_total_vendido"]]
-            .sum().sort_values("quantidade_vendida", ascending=False)
-        )
-        
-        df_itens = df_itens.sort_values("quantidade_vendida", ascending=False)
         n_itens = st.slider("Quantos itens mostrar no ranking?", 5, 100, 20, key="slider_top_itens")
         top_itens = df_itens.head(n_itens)
         
-        cti1, cti2 = st.columns(2)
-        with cti1:
-            fig_items_q = px.bar(
-                top_itens.sort_values("quantidade_vendida"),
-                x="quantidade_vendida",
-                y="item",
-                orientation="h",
-                title=f"Top {n_itens} Itens por Quantidade",
-                labels={"quantidade_vendida":"Quantidade","item":"Item"}
-            )
-            fig_items_q.update_layout(yaxis={"categoryorder": "total ascending"})
-            st.plotly_chart(fig_items_q, use_container_width=True)
-        
-        with cti2:
-            fig_items_v = px.bar(
-                top_itens.sort_values("valor_total_vendido"),
-                x="valor_total_vendido",
-                y="item",
-                orientation="h",
-                title=f"Top {n_itens} Itens por Valor (ao custo)",
-                labels={"valor_total_vendido":"Valor (R$)","item":"Item"}
-            )
-            fig_items_v.update_layout(yaxis={"categoryorder": "total ascending"})
-            st.plotly_chart(fig_items_v, use_container_width=True)
+        fig_itens = _hbar_pair(top_itens, "item", [
+            ("quantidade_vendida", f"Top {n_itens} Itens por Quantidade", "Quantidade"),
+            ("valor_total_vendido", f"Top {n_itens} Itens por Valor (ao custo)", "Valor (R$)"),
+        ], horizontal_spacing=0.25)
+        st.plotly_chart(fig_itens, use_container_width=True)
         
         st.dataframe(top_itens, use_container_width=True)
         st.download_button(
             "📥 Exportar Top Itens (CSV)",
-            df_itens.to_csv(index=False).encode("utf-8"),
+            cached_csv_bytes(df_itens),
             "ranking_top_itens.csv",
             "text/csv"
         )
@@ -1726,11 +2252,7 @@ elif page == "Gráfico de Vendas":
         st.divider()
         if not filtro_cat and not filtro_sub:
             st.markdown("### Distribuição por Categoria (geral)")
-            df_cat = (
-                df_vendas.groupby('category')
-                .agg({'quantidade_vendida':'sum','valor_total_vendido':'sum'})
-                .reset_index().sort_values('quantidade_vendida', ascending=False)
-            )
+            df_cat = sales_by_category(dias)
             c1, c2 = st.columns(2)
             with c1:
                 st.plotly_chart(px.pie(df_cat, values='quantidade_vendida', names='category', title='Vendas por Categoria (Qtd)'), use_container_width=True)
@@ -1740,11 +2262,34 @@ elif page == "Gráfico de Vendas":
         st.divider()
         st.download_button(
             "📥 Exportar Dados de Vendas (CSV — filtros aplicados)",
-            df_prod.to_csv(index=False).encode("utf-8"),
+            cached_csv_bytes(df_prod),
             f"vendas_{periodo.lower().replace(' ','_')}_filtrado.csv",
             "text/csv"
         )
 
+# ==========================================
+# DESPACHO DAS PÁGINAS
+# ==========================================
+PAGE_HANDLERS = {
+    "Cadastrar Tipo/Subtipo": _page_cadastrar_tipo,
+    "Cadastrar Variante": _page_cadastrar_variante,
+    "Movimentar Estoque": _page_movimentar,
+    "Baixa por PDF": _page_baixa_pdf,
+    "Estoque Atual": _page_estoque_atual,
+    "Histórico": _page_historico,
+    "Exportar CSV": _page_exportar_csv,
+    "Editar Variante": _page_editar_variante,
+    "Remover Variante": _page_remover_variante,
+    "Mapeamento de SKUs": _page_mapeamento,
+    "Gerenciar SKU Base": _page_sku_base,
+    "Custo por Categoria/Subtipo (em massa)": _page_custo_em_massa,
+    "Contagem de Estoque": _page_contagem,
+    "Valor do Estoque": _page_valor_estoque,
+    "Gráfico de Vendas": _page_vendas,
+}
+
+PAGE_HANDLERS[page]()
+
 # -------- Rodapé --------
 st.divider()
 st.caption("© Controle de Estoque — feito com Streamlit + SQLite. Auditoria por movimentação e saldo por SKU.")
\ No newline at end of file